@@ -6,7 +6,7 @@
 {
     "name": "Connector Amazon",
     "summary": "Connector for selling on Amazon Marketplace",
-    "version": "8.0.1.0.1",
+    "version": "8.0.1.0.2",
     "category": "Sales",
     "website": "www.akretion.com",
     "author": " Akretion",
@@ -24,12 +24,15 @@
         # Dependency on connector are just here for a better usability
         # Maybe we will remove it in the futur if it's problematic
         "connector_base_product",
+        # jobs of the sale reports imported by chunks
+        "connector",
         "sale_automatic_workflow",
         "base_sparse_field",
         "keychain",
         "attachment_base_synchronize",
         "web_m2x_options",
         "account_move_so_import",
+        "delivery",
     ],
     "data": [
         "views/amazon_backend_view.xml",
@@ -37,6 +40,9 @@
         "views/partner_view.xml",
         "views/sale_view.xml",
         "views/metadata_view.xml",
+        "views/import_run_view.xml",
+        "views/feed_view.xml",
+        "views/stock_view.xml",
         "data/data.xml",
         "security/ir.model.access.csv",
     ],
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+
+def migrate(cr, version):
+    """ Fill the amazon order id of the sales imported before it existed,
+        then of their invoices and invoice move lines: the settlements
+        of these orders are matched and reconciled too
+    """
+    if not version:
+        return
+    # the origin of an imported sale is the Amazon order id,
+    # its name the order id with the prefix of the backend
+    cr.execute("""
+        UPDATE sale_order AS so
+        SET amazon_order_id = COALESCE(
+            NULLIF(so.origin, ''),
+            substr(so.name, length(backend.prefix) + 1))
+        FROM (
+            SELECT id, COALESCE(sale_prefix, '') AS prefix
+            FROM amazon_backend
+            ) AS backend
+        WHERE backend.id = so.amazon_backend_id
+            AND so.amazon_order_id IS NULL
+            AND (NULLIF(so.origin, '') IS NOT NULL OR
+                 left(so.name, length(backend.prefix)) = backend.prefix)
+        """)
+    # the invoices of one order only
+    cr.execute("""
+        UPDATE account_invoice AS invoice
+        SET amazon_order_id = origin.amazon_order_id
+        FROM (
+            SELECT rel.invoice_id, min(so.amazon_order_id) AS amazon_order_id
+            FROM sale_order_invoice_rel AS rel
+            JOIN sale_order AS so ON so.id = rel.order_id
+            WHERE so.amazon_order_id IS NOT NULL
+            GROUP BY rel.invoice_id
+            HAVING count(DISTINCT so.amazon_order_id) = 1
+            ) AS origin
+        WHERE invoice.id = origin.invoice_id
+            AND invoice.amazon_order_id IS NULL
+        """)
+    cr.execute("""
+        UPDATE account_move_line AS line
+        SET amazon_order_id = invoice.amazon_order_id
+        FROM account_invoice AS invoice
+        WHERE line.move_id = invoice.move_id
+            AND invoice.amazon_order_id IS NOT NULL
+            AND line.amazon_order_id IS NULL
+        """)
@@ -2,10 +2,20 @@
 
 from . import sale
 from . import amazon_backend
+from . import checkpoint
+from . import import_run
 from . import keychain
 from . import attachment
+from . import report_chunk
 from . import amazon_sale_importer
 from . import amazon_payment_importer
+from . import amazon_listing_importer
+from . import amazon_feed
+from . import amazon_stock_exporter
+from . import amazon_price_exporter
+from . import amazon_shipment_exporter
+from . import stock
 from . import product
 from . import partner
+from . import country
 from . import account
@@ -3,7 +3,7 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from openerp import fields, models
+from openerp import api, fields, models
 
 
 class AccountJournal(models.Model):
@@ -11,3 +11,29 @@ class AccountJournal(models.Model):
 
     import_type = fields.Selection(
         selection_add=[('amazon_flat_v2', 'Amazon Flat V2')])
+
+
+class AccountInvoice(models.Model):
+    _inherit = 'account.invoice'
+
+    amazon_order_id = fields.Char(
+        string='Amazon Order Id', index=True, copy=False, readonly=True)
+
+    @api.multi
+    def finalize_invoice_move_lines(self, move_lines):
+        """ Settlements find the receivable lines of their orders
+            with the amazon order id
+        """
+        move_lines = super(AccountInvoice, self).finalize_invoice_move_lines(
+            move_lines)
+        if self.amazon_order_id:
+            for line in move_lines:
+                line[2]['amazon_order_id'] = self.amazon_order_id
+        return move_lines
+
+
+class AccountMoveLine(models.Model):
+    _inherit = 'account.move.line'
+
+    amazon_order_id = fields.Char(
+        string='Amazon Order Id', index=True, copy=False, readonly=True)
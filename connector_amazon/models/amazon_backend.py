@@ -5,12 +5,22 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import base64
-import time
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 from openerp import _, api, fields, models
 from openerp.exceptions import Warning as UserError
+from openerp.tools import ustr
 
 from .attachment import SUPPORTED_REPORT
+from .import_run import ImportMetrics, get_metrics
+from .mws_connection import AmazonMWSConnection
 import logging
 _logger = logging.getLogger(__name__)
 
@@ -20,14 +30,16 @@ except ImportError:
     _logger.debug('Cannot `import iso8601` library.')
 
 try:
-    from boto.mws.connection import MWSConnection
     from boto.exception import BotoServerError
 except ImportError:
     _logger.debug('Cannot `import boto` library.')
 
 
 KEYCHAIN_HELP = "Data store by keychain (Settings > Configuration > Keychain)"
-SECONDS_AFTER_EXCEPTION = 60
+# Amazon keys of the delivery address used to compute its hash
+ADDRESS_HASH_KEYS = [
+    'name', 'phone', 'street', 'street2', 'street3', 'city', 'state', 'zip',
+    'country']
 
 
 class AmazonBackend(models.Model):
@@ -82,10 +94,19 @@ class AmazonBackend(models.Model):
     fba = fields.Boolean(
         string='Fulfillment By Amazon',
         help="Allow to access to Fulfillment by Amazon features.")
+    export_shipment_from = fields.Datetime(
+        string="Confirm Shipments From", required=True,
+        default=fields.datetime.today(),
+        help="Confirm to Amazon the sales delivered from this date.")
     import_fba_from = fields.Datetime(
         string="Import FBA From", required=True,
         default=fields.datetime.today(),
         help="Import Fulfillment by Amazon sales from this date.")
+    warehouse_id = fields.Many2one(
+        comodel_name='stock.warehouse', string='Stock Warehouse',
+        track_visibility='onchange',
+        help="Its available stock is sent to Amazon by the stock feed. "
+             "The warehouse of the company is used when empty")
     fba_warehouse_id = fields.Many2one(
         comodel_name='stock.warehouse', string='Warehouse',
         track_visibility='onchange',
@@ -99,10 +120,6 @@ class AmazonBackend(models.Model):
         help="Choose the right workflow: for FBA, the best workflow "
              "is the automatic one \nbecause your sales "
              "are delivered and paid (default one is manual)")
-    elapsed_time = fields.Selection(selection=[
-        (2, '2 seconds'), (4, '4 seconds'), (6, '6 seconds')], default=4,
-        help="Time elasped between 2 FBA sales imports:\n"
-             "prevent to be throttled by Amazon")
     sale_journal_id = fields.Many2one(
         'account.journal',
         'Sale Journal')
@@ -118,16 +135,43 @@ class AmazonBackend(models.Model):
     bank_journal_id = fields.Many2one(
         'account.journal',
         'Bank Journal')
+    download_threads = fields.Integer(
+        string='Concurrent Downloads', default=4,
+        help="Number of reports or FBA sale lines downloaded at the same "
+             "time, while the previous ones are stored. Amazon quotas "
+             "are respected whatever the number")
+    sale_import_batch_size = fields.Integer(
+        string='Sale Import Batch Size', default=100,
+        help="Number of sales of a report created in the same savepoint "
+             "and committed together. A sale in error is isolated and "
+             "reported without stopping the import of the others")
+    sale_import_jobs = fields.Boolean(
+        string='Import Reports with Jobs',
+        help="Cut the sale reports in chunks of whole orders, imported "
+             "in parallel by the job runner workers")
+    sale_import_chunk_size = fields.Integer(
+        string='Orders per Job', default=1000,
+        help="Number of orders of a sale report imported by one job")
+    match_unhashed_address = fields.Boolean(
+        string='Match Unhashed Addresses', default=True,
+        help="Delivery addresses are searched by their address hash.\n"
+             "Check this to also compare every address field when the hash "
+             "is unknown: needed to reuse the addresses imported before "
+             "the hash existed, but slower")
 
     def _get_connection(self):
         self.ensure_one()
         account = self._get_existing_keychain()
+        kwargs = {'host': self.host}
+        port = self.env.context.get('amazon_mws_port')
+        if port:
+            # local stand-in of the api, see tests/fake_mws.py
+            kwargs.update(host='localhost', is_secure=False, port=port)
         try:
-            return MWSConnection(
+            return AmazonMWSConnection(
                 self.accesskey,
                 account.get_password(),
-                Merchant=self.merchant,
-                host=self.host)
+                Merchant=self.merchant, **kwargs)
         except Exception as e:
             raise UserError(u"Amazon response:\n\n%s" % e)
 
@@ -143,48 +187,199 @@ class AmazonBackend(models.Model):
         }
 
     @api.multi
-    def _import_report_id(self, mws, report):
-        # TODO check if report already exist
-        attch_obj = self.env['ir.attachment.metadata']
-        if attch_obj.search([
-                ('amazon_backend_id', '=', self.id),
-                ('name', '=', report.ReportId)]):
-            _logger.debug("Report %s already exist, skip it" % report.ReportId)
-        else:
-            _logger.debug("Import Report %s" % report.ReportId)
-            data = mws_api_call(
-                mws, 'get_report', {'ReportId': report.ReportId},
-                "Import Report '%s'")
-            vals = self._prepare_attachment(report)
-            vals['datas'] = base64.encodestring(data)
-            self.env['ir.attachment.metadata'].create(vals)
-            # Warning, we volontary commit here the report imported
-            # this avoid useless re-importing it if the process failed
-            self._cr.commit()
+    def _create_report_attachment(self, report, path, size, sha1):
+        """ Create the attachment of a report downloaded in path:
+            the file is moved to the filestore instead of being loaded
+            in memory, unless the attachments are stored in the database.
+            The temporary file is removed
+        """
+        self.ensure_one()
+        vals = self._prepare_attachment(report)
+        try:
+            if self.env['ir.attachment']._storage() == 'file':
+                vals.update({
+                    'store_fname': self._store_report_file(path, sha1),
+                    'file_size': size,
+                })
+            else:
+                with open(path, 'rb') as report_file:
+                    vals['datas'] = base64.encodestring(report_file.read())
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        return self.env['ir.attachment.metadata'].create(vals)
+
+    @api.model
+    def _store_report_file(self, path, sha1):
+        """ Move the file to the filestore, return its store_fname:
+            same layout as ir.attachment._get_path
+        """
+        attachment_m = self.env['ir.attachment']
+        # retro compatibility
+        fname = sha1[:3] + '/' + sha1
+        if os.path.isfile(attachment_m._full_path(fname)):
+            return fname
+        fname = sha1[:2] + '/' + sha1
+        full_path = attachment_m._full_path(fname)
+        if not os.path.isfile(full_path):
+            dirname = os.path.dirname(full_path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            shutil.move(path, full_path)
+        return fname
+
+    @api.multi
+    def _iter_downloads(self, fetch, items, metrics=None):
+        """ Yield fetch(mws, item) for each item, in order.
+            The calls are done by download_threads threads, each one
+            with its own connection: fetch must not use the ORM.
+            At most download_threads results wait for the caller
+        """
+        self.ensure_one()
+        size = self.download_threads or 1
+        connections = [self._get_connection() for index in range(size)]
+        free = list(connections)
+
+        def call(item):
+            # a connection is used by one thread at a time
+            mws = free.pop()
+            try:
+                return fetch(mws, item)
+            finally:
+                free.append(mws)
+
+        pool = ThreadPool(size)
+        items = iter(items)
+        pending = deque(pool.apply_async(call, (item,))
+                        for item in islice(items, size))
+        try:
+            while pending:
+                result = pending.popleft().get()
+                for item in islice(items, 1):
+                    pending.append(pool.apply_async(call, (item,)))
+                yield result
+        finally:
+            pool.terminate()
+            if metrics is not None:
+                for mws in connections:
+                    metrics.add_connection(mws)
+
+    @api.multi
+    def _list_reports(self, mws):
+        """ Return all the available reports of the GetReportList pages """
+        self.ensure_one()
+        kwargs = {'ReportTypeList': SUPPORTED_REPORT.keys()}
+        start = fields.Datetime.from_string(self.import_report_from)
+        if start:
+            # Be carefull Amazon documentation is outdated
+            # the key for filtering the date is AvailableFromDate
+            # and not RequestedFromDate
+            kwargs['AvailableFromDate'] = start.isoformat()
+        reports = []
+        for response in mws.iter_call('GetReportList', **kwargs):
+            reports.extend(response._result.ReportInfo)
+        return reports
+
+    @api.multi
+    def _get_existing_report_ids(self, report_ids):
+        self.ensure_one()
+        if not report_ids:
+            return set()
+        attachments = self.env['ir.attachment.metadata'].search_read([
+            ('amazon_backend_id', '=', self.id),
+            ('amazon_report_id', 'in', list(report_ids)),
+        ], ['amazon_report_id'])
+        return set(attachment['amazon_report_id']
+                   for attachment in attachments)
+
+    @api.multi
+    def _get_checkpoint(self, channel):
+        self.ensure_one()
+        checkpoint_m = self.env['amazon.import.checkpoint']
+        checkpoint = checkpoint_m.search([
+            ('backend_id', '=', self.id), ('channel', '=', channel)])
+        if not checkpoint:
+            checkpoint = checkpoint_m.create({
+                'backend_id': self.id, 'channel': channel})
+        return checkpoint
+
+    @contextmanager
+    def _import_run(self, run_type, mws=None, attachment=None):
+        """ Measure an import, saved as an amazon.import.run
+            with the requests done by the mws connection
+        """
+        self.ensure_one()
+        metrics = ImportMetrics(self._cr)
+        run_m = self.env['amazon.import.run']
+        try:
+            yield metrics
+        except Exception as e:
+            metrics.add_connection(mws)
+            run_m._save(metrics, self, run_type,
+                        attachment=attachment, error=e)
+            raise
+        metrics.add_connection(mws)
+        run_m._save(metrics, self, run_type, attachment=attachment)
 
     @api.multi
     def import_report(self):
         for record in self:
+            checkpoint = record._get_checkpoint('report')
             mws = record._get_connection()
-            kwargs = {'ReportTypeList': SUPPORTED_REPORT.keys()}
-            start = fields.Datetime.from_string(record.import_report_from)
-            if start:
-                # Be carefull Amazon documentation is outdated
-                # the key for filtering the date is AvailableFromDate
-                # and not RequestedFromDate
-                kwargs['AvailableFromDate'] = start.isoformat()
-            stop = None
-            if mws:
-                for response in mws.iter_call('GetReportList', **kwargs):
-                    for report in response._result.ReportInfo:
-                        record._import_report_id(mws, report)
-                        stop = max(report.AvailableDate, stop)
-                if not stop:
-                    _logger.warning(
-                        "There are no Amazon reports for the backend '%s'",
-                        record.name)
-                    continue
-                record.import_report_from = iso8601.parse_date(stop)
+            if not mws:
+                continue
+            with record._import_run('report', mws=mws) as metrics:
+                record._import_reports(mws, checkpoint, metrics)
+
+    @api.multi
+    def _import_reports(self, mws, checkpoint, metrics):
+        self.ensure_one()
+        with metrics.phase('list reports'):
+            reports = self._list_reports(mws)
+        if not reports:
+            _logger.warning(
+                "There are no Amazon reports for the backend '%s'",
+                self.name)
+            return
+        report_ids = [report.ReportId for report in reports]
+        # reports processed by a previous run which failed
+        # or already stored are not downloaded
+        known = checkpoint._get_processed_ids()
+        known |= self._get_existing_report_ids(set(report_ids) - known)
+        to_import = [report for report in reports
+                     if report.ReportId not in known]
+        _logger.debug("%s Amazon reports to import", len(to_import))
+        # reports are downloaded by threads while the previous ones
+        # are stored
+        downloads = self._iter_downloads(
+            fetch_report, to_import, metrics=metrics)
+        try:
+            for download in metrics.iter_phase('download', downloads):
+                with metrics.phase('store'):
+                    self._create_report_attachment(*download)
+                    report = download[0]
+                    checkpoint._mark_processed(
+                        report.ReportId, report.AvailableDate)
+                    # Warning, we volontary commit here the report
+                    # imported this avoid useless re-importing it
+                    # if the process failed
+                    self._cr.commit()
+                metrics.incr('records')
+        finally:
+            downloads.close()
+        stop = max(report.AvailableDate for report in reports)
+        self.import_report_from = iso8601.parse_date(stop)
+        checkpoint._forget_before(self.import_report_from)
+
+    @api.multi
+    def populate_amazon_binding(self):
+        """ Bind all the products with a reference to the backends """
+        for record in self:
+            count = self.env['amazon.product']._populate(record)
+            record.message_post(
+                body=_("%s products bound") % count,
+                subtype='mail.mt_comment')
+        return True
 
     @api.model
     def import_all_report(self, domain=None):
@@ -193,21 +388,157 @@ class AmazonBackend(models.Model):
         self.search(domain).import_report()
 
     @api.multi
-    def _create_sale(self, sale):
+    def _prepare_import_cache(self, sales, cache=None):
+        """ Gather in a few queries the data shared by the sales
+            of an import run.
+            The returned dict is given to each _create_sale call
+        """
+        self.ensure_one()
+        if cache is None:
+            cache = {}
+        for key in ('products', 'customers', 'addresses'):
+            cache.setdefault(key, {})
+        cache.setdefault('orders', set())
+        skus = set(line['sku'] for sale in sales for line in sale['lines'])
+        skus -= set(cache['products'])
+        cache['products'].update(self._get_products_from_sku(skus))
+        emails = set(sale['partner']['email'] for sale in sales
+                     if sale['partner']['email'])
+        emails -= set(cache['customers'])
+        cache['customers'].update(self._get_customers_from_email(emails))
+        hashes = set(self._get_address_hash(sale['part_ship'])
+                     for sale in sales)
+        hashes -= set(cache['addresses'])
+        cache['addresses'].update(self._get_addresses_from_hash(hashes))
+        return cache
+
+    @api.multi
+    def _get_products_from_sku(self, skus):
+        """ Return a dict sku: product id for the bound skus """
+        self.ensure_one()
+        if not skus:
+            return {}
+        bindings = self.env['amazon.product'].search([
+            ('external_id', 'in', list(skus)),
+            ('backend_id', '=', self.id)])
+        return {binding.external_id: binding.record_id.id
+                for binding in bindings}
+
+    @api.model
+    def _get_customers_from_email(self, emails):
+        """ Return a dict email: partner id """
+        if not emails:
+            return {}
+        customers = {}
+        for partner in self.env['res.partner'].search(
+                [('email', 'in', list(emails))]):
+            # keep the first partner found like a search on one email
+            customers.setdefault(partner.email, partner.id)
+        return customers
+
+    @api.model
+    def _get_addresses_from_hash(self, hashes):
+        """ Return a dict address hash: partner id,
+            active or not partners are returned
+        """
+        if not hashes:
+            return {}
+        addresses = {}
+        for partner in self.env['res.partner'].with_context(
+                active_test=False).search(
+                [('amazon_address_hash', 'in', list(hashes))]):
+            addresses.setdefault(partner.amazon_address_hash, partner.id)
+        return addresses
+
+    @api.model
+    def _get_address_hash(self, part_ship):
+        """ Hash of the normalized delivery address as given by Amazon """
+        values = []
+        for key in ADDRESS_HASH_KEYS:
+            value = part_ship.get(key) or u''
+            if not isinstance(value, unicode):
+                value = unicode(value)
+            values.append(u' '.join(value.split()).lower())
+        return hashlib.sha1(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+    @api.multi
+    def _create_sales(self, sales, cache=None):
+        """ Create a chunk of sales in one savepoint. If it fails,
+            sales are created again one by one to isolate the wrong ones.
+            Return the error messages of the sales not created
+        """
+        self.ensure_one()
+        if cache is None:
+            cache = self._prepare_import_cache(sales)
+        error = self._create_sales_in_savepoint(sales, cache)
+        if error is None:
+            return []
+        errors = []
+        for sale in sales:
+            if len(sales) > 1:
+                error = self._create_sales_in_savepoint([sale], cache)
+            if error is not None:
+                origin = sale['auto_insert']['origin']
+                message = getattr(error, 'value', False) or ustr(error)
+                _logger.warning("Amazon sale %s not imported: %s",
+                                origin, message)
+                errors.append(u"%s [%s]" % (message, origin))
+        get_metrics(cache).incr('errors', len(errors))
+        return errors
+
+    @api.multi
+    def _create_sales_in_savepoint(self, sales, cache):
+        """ Return the exception raised by the creation, None if done """
+        # partners created in a rollbacked savepoint must leave the cache
+        saved = {key: cache[key].copy() for key in ('customers', 'addresses')}
+        try:
+            with self._cr.savepoint():
+                vals_list = [self._prepare_sale_vals(sale, cache=cache)
+                             for sale in sales]
+                with get_metrics(cache).phase('order creation'):
+                    for vals in vals_list:
+                        self.env['sale.order'].create(vals)
+        except Exception as e:
+            cache.update(saved)
+            self.env.invalidate_all()
+            return e
+        get_metrics(cache).incr('records', len(sales))
+        return None
+
+    @api.multi
+    def _create_sale(self, sale, cache=None):
         """ We process sale order of the file"""
         self.ensure_one()
+        vals = self._prepare_sale_vals(sale, cache=cache)
+        metrics = get_metrics(cache)
+        with metrics.phase('order creation'):
+            sale_order = self.env['sale.order'].create(vals)
+        metrics.incr('records')
+        return sale_order
+
+    @api.multi
+    def _prepare_sale_vals(self, sale, cache=None):
+        self.ensure_one()
+        if cache is None:
+            cache = self._prepare_import_cache([sale])
+        metrics = get_metrics(cache)
         name = self._build_sale_order_name(sale['auto_insert']['origin'])
-        partner = self._get_customer(sale['partner'])
-        part_ship = self._get_delivery_address(
-            sale['part_ship'], sale['auto_insert']['origin'], partner)
+        with metrics.phase('partner matching'):
+            partner = self._get_customer(sale['partner'], cache=cache)
+            part_ship = self._get_delivery_address(
+                sale['part_ship'], sale['auto_insert']['origin'], partner,
+                cache=cache)
         vals = {
             'name': name,
             'partner_id': partner.id,
             'partner_shipping_id': part_ship.id,
             'pricelist_id': self.pricelist_id.id,
             'amazon_backend_id': self.id,
+            'amazon_order_id': sale['auto_insert']['origin'],
         }
-        ship_price = self._prepare_products(sale['lines'])
+        with metrics.phase('products'):
+            ship_price = self._prepare_products(
+                sale['lines'], products=cache['products'])
         vals['order_line'] = [
             (0, 0, {key: val for key, val in line.items()
                     if key in self.env['sale.order.line']._fields.keys()})
@@ -226,37 +557,85 @@ class AmazonBackend(models.Model):
             for field in sale['auto_insert']:
                 if field in self.env['sale.order']._fields:
                     vals[field] = sale['auto_insert'][field]
-        return self.env['sale.order'].create(vals)
+        return vals
 
-    def _get_customer(self, customer_data):
+    @contextmanager
+    def _lock_customers(self, emails):
+        """ Serialize with the other workers the creation of the customers
+            of these emails.
+            Locks are taken for the session, then the transaction is
+            committed: the next queries see the customers committed by
+            the worker which held the lock before
+        """
+        keys = sorted(set(
+            int(hashlib.sha1(email.encode('utf-8')).hexdigest()[:15], 16)
+            for email in emails if email))
+        if not keys:
+            yield
+            return
+        self._cr.execute("""
+            SELECT pg_advisory_lock(key) FROM (
+                SELECT unnest(%s::bigint[]) AS key ORDER BY key) AS keys
+            """, (keys,))
+        self._cr.commit()
+        try:
+            yield
+        except Exception:
+            self._cr.rollback()
+            raise
+        finally:
+            self._cr.execute("""
+                SELECT pg_advisory_unlock(key)
+                FROM unnest(%s::bigint[]) AS key
+                """, (keys,))
+
+    def _get_customer(self, customer_data, cache=None):
+        """ cache: dict of the import run, see _prepare_import_cache """
         partner_m = self.env['res.partner']
-        partner = False
-        if customer_data['email']:
-            partner = partner_m.search(
-                [('email', '=', customer_data['email'])])
-        if not partner:
-            partner = partner_m.create(customer_data)
-        return partner[0]
-
-    def _get_delivery_address(self, part_ship, origin, partner):
+        email = customer_data['email']
+        if cache is None:
+            cache = {'customers': self._get_customers_from_email(
+                email and [email])}
+        if email and email in cache['customers']:
+            return partner_m.browse(cache['customers'][email])
+        partner = partner_m.create(customer_data)
+        if email:
+            # the next orders of this buyer in the run reuse it
+            cache['customers'][email] = partner.id
+        return partner
+
+    def _get_delivery_address(self, part_ship, origin, partner, cache=None):
+        """ cache: dict of the import run, see _prepare_import_cache """
         partner_m = self.env['res.partner']
+        address_hash = self._get_address_hash(part_ship)
+        if cache is None:
+            cache = {'addresses': self._get_addresses_from_hash(
+                [address_hash])}
+        if address_hash in cache['addresses']:
+            return partner_m.browse(cache['addresses'][address_hash])
         self._prepare_address(part_ship, origin)
-        domain = [
-            '|',
-            ('active', '=', True),
-            ('active', '=', False)]
-        domain.extend([
-            (fieldname, '=', val)
-            for fieldname, val in part_ship.items()
-            if fieldname in partner_m._fields])
-        # we search identical partner active or not
-        address = partner_m.search(domain)
+        address = partner_m.browse()
+        if self.match_unhashed_address:
+            domain = [
+                '|',
+                ('active', '=', True),
+                ('active', '=', False)]
+            domain.extend([
+                (fieldname, '=', val)
+                for fieldname, val in part_ship.items()
+                if fieldname in partner_m._fields])
+            # we search identical partner active or not
+            address = partner_m.search(domain, limit=1)
+            if address:
+                address.amazon_address_hash = address_hash
         if not address:
             part_ship['parent_id'] = partner.id
             vals = {k: v for k, v in part_ship.items()
                     if k in partner_m._fields}
+            vals['amazon_address_hash'] = address_hash
             address = partner_m.create(vals)
-        return address[0]
+        cache['addresses'][address_hash] = address.id
+        return address
 
     def _prepare_address(self, part_ship, origin):
         partner_m = self.env['res.partner']
@@ -267,22 +646,24 @@ class AmazonBackend(models.Model):
             part_ship['street2'] = '%s %s' % (
                 part_ship['street2'], part_ship['street3'])
 
-    def _prepare_products(self, lines):
+    def _prepare_products(self, lines, products=None):
         """ - check if product exists in amazon backend
             - gather shipping price
             return shipping_price
+            products: dict sku: product id, searched if not given
         """
+        if products is None:
+            products = self._get_products_from_sku(
+                set(line['sku'] for line in lines))
         line_count, shipping_price = 0, 0
         products_in_exception = []
         for line in lines:
             shipping_line = float(line.get('shipping'))
             if shipping_line:
                 shipping_price += shipping_line
-            binding = self.env['amazon.product'].search(
-                [('external_id', '=', line['sku']),
-                 ('backend_id', '=', self.id)])
-            if binding:
-                lines[line_count]['product_id'] = binding[0].record_id.id
+            product_id = products.get(line['sku'])
+            if product_id:
+                lines[line_count]['product_id'] = product_id
             else:
                 self._worry_about_product_in_exception(
                     lines, products_in_exception, line_count)
@@ -303,30 +684,50 @@ class AmazonBackend(models.Model):
     def _get_state_country(self, part_ship, origin):
         """ country is mandatory, not state
         """
+        country_m = self.env['res.country']
         country_code = part_ship.get('country')
         state_name = part_ship.get('state')
-        country = self.env['res.country'].search([('code', '=', country_code)])
-        if not country or not country_code:
+        country_id = country_m._amazon_get_country_id(country_code)
+        if not country_id:
             raise UserError(
                 _("Unknow country code %s in sale %s ") % (
                     country_code, origin))
-        state = False
+        state_id = False
         if state_name:
-            state = self.env['res.country.state'].search(
-                [('name', '=ilike', state_name)])
-            if not state:
+            state_id = country_m._amazon_get_state_id(country_id, state_name)
+            if not state_id:
                 _logger.debug(
                     _("Unknown state name %s in sale %s, skip it")
                     % (state_name, origin))
-        return(country.id, getattr(state, 'id', state))
+        return(country_id, state_id)
 
     def _build_sale_order_name(self, name):
         return (self.sale_prefix or '') + name
 
-    def _should_skip_sale_order(self, order_name, is_fba=False):
+    @api.multi
+    def _get_existing_sale_names(self, order_names):
+        """ Return the set of the sale order names already in the ERP
+            for these Amazon order names
+        """
+        self.ensure_one()
+        names = [self._build_sale_order_name(name) for name in order_names]
+        if not names:
+            return set()
+        return set(sale['name'] for sale in self.env['sale.order'].search_read(
+            [('name', 'in', names)], ['name']))
+
+    def _should_skip_sale_order(self, order_name, is_fba=False, cache=None):
+        """ cache: dict of the import run, its 'orders' key is the set
+            of the existing sale names (see _get_existing_sale_names)
+            completed with the orders met in the run
+        """
         name = self._build_sale_order_name(order_name)
-        if self.env[('sale.order')].search([('name', '=', name)]):
+        if cache is None:
+            cache = {'orders': self._get_existing_sale_names([order_name])}
+        if name in cache['orders']:
             return True
+        # an order found twice in the same run is only imported once
+        cache['orders'].add(name)
         return False
 
     @api.multi
@@ -335,46 +736,101 @@ class AmazonBackend(models.Model):
         """
         for record in self:
             mws = record._get_connection()
-            start = fields.Datetime.from_string(record.import_fba_from)
-            try:
-                sales = mws.list_orders(
-                    LastUpdatedAfter=start.isoformat(),
-                    OrderStatus=['Shipped'],
-                    FulfillmentChannel=["AFN"],
-                    MarketplaceId=record.marketplace.split(';'))
-                _logger.info('%s FBA amazon sales will be imported',
-                             len(sales.ListOrdersResult.Orders.Order))
-                max_date = None
-                for order in sales.ListOrdersResult.Orders.Order:
-                    max_date = max(max_date, order.LastUpdateDate)
-                    if record._should_skip_sale_order(
-                            order.AmazonOrderId, is_fba=True):
-                        _logger.debug(
-                            "Order %s already have been imported, skip it",
-                            order.AmazonOrderId)
-                        continue
-                    _logger.debug(order)
-                    data = record._extract_fba_sale(mws, order)
-                    record._create_sale(data)
-                    record._cr.commit()
-                    # prevent to be throttled by Amazon
-                    time.sleep(record.elapsed_time)
-                if max_date:
-                    record.import_fba_from = iso8601.parse_date(max_date)
-                    # We commit to avoid than a fail sale import
-                    # prevent to save other valid sales
-                    record._cr.commit()
-            except BotoServerError as bs:
-                # pass
-                message = _('Amazon BotoServerError %s %s %s') % (
-                    bs.status, bs.reason, bs.body)
-                raise UserError(message)
-            except Exception as e:
-                message = "Amazon exception '%s'" % e.message
-                raise UserError(e.message or e)
+            checkpoint = record._get_checkpoint('fba')
+            # customers found or created are kept for the next pages
+            # orders processed by a previous run which failed are skipped
+            # without downloading their lines
+            cache = {'orders': set(
+                record._build_sale_order_name(order_id)
+                for order_id in checkpoint._get_processed_ids())}
+            with record._import_run('fba', mws=mws) as metrics:
+                cache['metrics'] = metrics
+                try:
+                    max_date = None
+                    for orders in metrics.iter_phase(
+                            'list orders', record._iter_fba_orders(mws)):
+                        max_date = max(max_date, record._import_fba_orders(
+                            mws, orders, cache, checkpoint))
+                    # Amazon does not sort the pages by update date:
+                    # the next import starts after the last page only
+                    if max_date:
+                        record.import_fba_from = iso8601.parse_date(max_date)
+                        checkpoint._forget_before(record.import_fba_from)
+                        self._cr.commit()
+                except BotoServerError as bs:
+                    # pass
+                    message = _('Amazon BotoServerError %s %s %s') % (
+                        bs.status, bs.reason, bs.body)
+                    raise UserError(message)
+                except Exception as e:
+                    message = "Amazon exception '%s'" % e.message
+                    raise UserError(e.message or e)
+
+    @api.multi
+    def _iter_fba_orders(self, mws):
+        """ Yield the FBA orders page by page,
+            the next pages are requested with the NextToken
+        """
+        self.ensure_one()
+        start = fields.Datetime.from_string(self.import_fba_from)
+        for response in mws.iter_call(
+                'ListOrders',
+                LastUpdatedAfter=start.isoformat(),
+                OrderStatus=['Shipped'],
+                FulfillmentChannel=["AFN"],
+                MarketplaceId=self.marketplace.split(';')):
+            orders = response._result.Orders.Order
+            _logger.info('%s FBA amazon sales will be imported',
+                         len(orders))
+            yield orders
 
     @api.multi
-    def _extract_fba_sale(self, mws, order):
+    def _import_fba_orders(self, mws, orders, cache, checkpoint):
+        """ Import a page of FBA orders,
+            return the last update date of the page
+            cache: dict of the import run, see _prepare_import_cache
+            checkpoint: records each imported order
+        """
+        self.ensure_one()
+        max_date = None
+        cache['orders'] |= self._get_existing_sale_names(
+            [order.AmazonOrderId for order in orders])
+        to_import = []
+        for order in orders:
+            max_date = max(max_date, order.LastUpdateDate)
+            if self._should_skip_sale_order(
+                    order.AmazonOrderId, is_fba=True, cache=cache):
+                _logger.debug(
+                    "Order %s already have been imported, skip it",
+                    order.AmazonOrderId)
+                continue
+            _logger.debug(order)
+            to_import.append(order)
+        # order lines are downloaded by threads while sales
+        # are created
+        metrics = get_metrics(cache)
+        downloads = self._iter_downloads(
+            fetch_order_items, to_import, metrics=metrics)
+        try:
+            for order, items in metrics.iter_phase('fetch items', downloads):
+                with metrics.phase('extract'):
+                    data = self._extract_fba_sale(mws, order, items=items)
+                with metrics.phase('prepare cache'):
+                    self._prepare_import_cache([data], cache=cache)
+                self._create_sale(data, cache=cache)
+                checkpoint._mark_processed(
+                    order.AmazonOrderId, order.LastUpdateDate)
+                with metrics.phase('commit'):
+                    self._cr.commit()
+        finally:
+            downloads.close()
+        return max_date
+
+    @api.multi
+    def _extract_fba_sale(self, mws, order, items=None):
+        """ items: ListOrderItems response of the order,
+            downloaded if not given
+        """
         self.ensure_one()
         # Sometime Amazon do not have the BuyerName set !
         if hasattr(order, 'BuyerName') and order.BuyerName:
@@ -416,9 +872,8 @@ class AmazonBackend(models.Model):
                 'country': shipping_address.get('CountryCode'),
             },
         }
-        items = mws_api_call(
-            mws, 'list_order_items', {'AmazonOrderId': order.AmazonOrderId},
-            "Import Sale '%s'")
+        if items is None:
+            items = fetch_order_items(mws, order)[1]
         lines = []
         for item in items.__dict__['ListOrderItemsResult'] \
                 .OrderItems.OrderItem:
@@ -444,6 +899,73 @@ class AmazonBackend(models.Model):
         sale['lines'] = lines
         return sale
 
+    @api.multi
+    def request_listing_report(self):
+        """ Ask Amazon to generate the listings report, it is imported
+            by the next report import
+        """
+        for record in self:
+            mws = record._get_connection()
+            mws_api_call(
+                mws, 'request_report',
+                {'ReportType': '_GET_MERCHANT_LISTINGS_DATA_'},
+                "Request report %s")
+
+    @api.model
+    def _request_listing_reports(self):
+        """ Triggered by cron """
+        self.search([]).request_listing_report()
+
+    @api.multi
+    def _get_stock_warehouse(self):
+        self.ensure_one()
+        return self.warehouse_id or self.env['stock.warehouse'].search(
+            [('company_id', '=', self.env.user.company_id.id)], limit=1)
+
+    @api.multi
+    def export_stock(self):
+        for record in self:
+            self.env['amazon.stock.exporter']._export(record)
+
+    @api.model
+    def _export_all(self, method):
+        """ Export each backend in its own transaction: the feeds
+            submitted to Amazon are kept when another backend fails
+        """
+        for backend in self.search([]):
+            try:
+                getattr(backend, method)()
+                self._cr.commit()
+            except Exception:
+                self._cr.rollback()
+                _logger.exception("Amazon %s of the backend %s failed",
+                                  method, backend.name)
+
+    @api.model
+    def _export_all_stock(self):
+        """ Triggered by cron """
+        self._export_all('export_stock')
+
+    @api.multi
+    def export_price(self):
+        for record in self:
+            self.env['amazon.price.exporter']._export(record)
+
+    @api.model
+    def _export_all_price(self):
+        """ Triggered by cron """
+        self._export_all('export_price')
+
+    @api.multi
+    def export_shipment(self):
+        for record in self:
+            self.env['amazon.shipment.exporter']._export(record)
+
+    @api.model
+    def _export_all_shipment(self):
+        """ Triggered by cron """
+        self._export_all('export_shipment')
+
     @api.model
     def _import_fba_sales(self):
         """ Triggered by cron """
@@ -456,24 +978,43 @@ def mws_api_call(mws, method, kwargs, message):
     """ called by:
         - mws.list_order_items(AmazonOrderId=order.AmazonOrderId)
         - mws.get_report(ReportId=report.ReportId)
+        Amazon quotas and throttled requests are handled by the connection
     """
+    _logger.debug(message % kwargs[kwargs.keys()[0]])
     try:
         data = getattr(mws, method)(**kwargs)
     except Exception as e:
-        if hasattr(e, 'error_code'):
-            if e.error_code == 'RequestThrottled':
-                _logger.info(
-                    "Request Throttled, please wait before auto retrying")
-                time.sleep(SECONDS_AFTER_EXCEPTION)
-                _logger.debug(message % kwargs[kwargs.keys()[0]])
-                data = getattr(mws, method)(kwargs)
-            else:
-                raise UserError(e)
-        else:
-            raise UserError(e)
+        raise UserError(e)
     return data
 
 
+def fetch_report(mws, report):
+    """ Download the report chunk by chunk in a new temporary file
+        Return the report info with the path, size and sha1 of the file,
+        can be called from a thread
+    """
+    _logger.debug("Import Report '%s'", report.ReportId)
+    handle, path = tempfile.mkstemp(prefix='amazon-')
+    try:
+        with os.fdopen(handle, 'wb') as report_file:
+            size, sha1 = mws.get_report_to_file(
+                report_file, ReportId=report.ReportId)
+    except Exception as e:
+        os.remove(path)
+        raise UserError(e)
+    return report, path, size, sha1
+
+
+def fetch_order_items(mws, order):
+    """ Return the order with its ListOrderItems response,
+        can be called from a thread
+    """
+    items = mws_api_call(
+        mws, 'list_order_items', {'AmazonOrderId': order.AmazonOrderId},
+        "Import Sale '%s'")
+    return order, items
+
+
 def extract_money(field, backend=None, item=None):
     """ field is <class 'boto.mws.response.ComplexMoney'>
     """
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+import logging
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from openerp import _, api, fields, models
+from openerp.exceptions import Warning as UserError
+
+_logger = logging.getLogger(__name__)
+
+INVENTORY_FEED = '_POST_INVENTORY_AVAILABILITY_DATA_'
+PRICE_FEED = '_POST_PRODUCT_PRICING_DATA_'
+FULFILLMENT_FEED = '_POST_FLAT_FILE_FULFILLMENT_DATA_'
+FEED_TYPES = [
+    (INVENTORY_FEED, 'Inventory'),
+    (PRICE_FEED, 'Prices'),
+    (FULFILLMENT_FEED, 'Shipment Confirmations'),
+]
+# encoding of the flat file feeds, declared in their content type
+FLAT_FILE_ENCODING = 'iso-8859-1'
+CONTENT_TYPES = {
+    INVENTORY_FEED: 'text/xml',
+    PRICE_FEED: 'text/xml',
+    FULFILLMENT_FEED: 'text/tab-separated-values; charset=%s'
+                      % FLAT_FILE_ENCODING,
+}
+# Amazon accepts up to 100 ids by GetFeedSubmissionList
+FEED_STATUS_CHUNK_SIZE = 100
+XML_ENVELOPE = u"""<?xml version="1.0" encoding="utf-8"?>
+<AmazonEnvelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" \
+xsi:noNamespaceSchemaLocation="amzn-envelope.xsd">
+<Header>
+<DocumentVersion>1.01</DocumentVersion>
+<MerchantIdentifier>%s</MerchantIdentifier>
+</Header>
+<MessageType>%s</MessageType>
+"""
+
+
+def xml_feed(merchant, message_type, messages):
+    """ Return the XML feed of the messages, the inner XML of each message
+        is given already escaped
+    """
+    parts = [XML_ENVELOPE % (escape(merchant), message_type)]
+    for message_id, message in enumerate(messages, 1):
+        parts.append(
+            u"<Message><MessageID>%s</MessageID>"
+            u"<OperationType>Update</OperationType>%s</Message>\n"
+            % (message_id, message))
+    parts.append(u"</AmazonEnvelope>\n")
+    return u''.join(parts).encode('utf-8')
+
+
+def parse_processing_report(data):
+    """ Return the number of messages processed and the errors
+        of the XML processing report, as (message id, sku, description)
+    """
+    root = etree.fromstring(data)
+    processed = root.findtext('.//ProcessingSummary/MessagesProcessed')
+    errors = []
+    for result in root.iterfind('.//Result'):
+        if result.findtext('ResultCode') != 'Error':
+            continue
+        errors.append((
+            result.findtext('MessageID'),
+            result.findtext('AdditionalInfo/SKU'),
+            result.findtext('ResultDescription')))
+    return int(processed or 0), errors
+
+
+def parse_flat_processing_report(data):
+    """ Same as parse_processing_report for the report of a flat file
+        feed, errors are (record number, order id, message)
+    """
+    processed = 0
+    errors = []
+    header = None
+    for line in data.splitlines():
+        values = line.strip('\r').split('\t')
+        if header is None:
+            if 'records processed' in line:
+                processed = int(values[-1] or 0)
+            elif values[0] == 'original-record-number':
+                header = values
+            continue
+        row = dict(zip(header, values))
+        if row.get('error-type') == 'Error':
+            errors.append((
+                row['original-record-number'], row.get('order-id') or None,
+                row.get('error-message')))
+    return processed, errors
+
+
+class AmazonFeed(models.Model):
+    _name = 'amazon.feed'
+    _description = 'Amazon Feed'
+    _order = 'date_submitted desc, id desc'
+    _rec_name = 'submission_id'
+
+    backend_id = fields.Many2one(
+        comodel_name='amazon.backend', string='Backend', required=True,
+        ondelete='cascade', index=True, readonly=True)
+    feed_type = fields.Selection(
+        selection=FEED_TYPES, string='Type', required=True, readonly=True)
+    state = fields.Selection(
+        selection=[
+            ('draft', 'To Submit'),
+            ('submitted', 'Submitted'),
+            ('done', 'Done'),
+            ('error', 'Error'),
+        ], required=True, readonly=True, default='draft')
+    submission_id = fields.Char(
+        string='Submission', readonly=True, index=True,
+        help="FeedSubmissionId given by Amazon")
+    date_submitted = fields.Datetime(string='Submitted on', readonly=True)
+    date_done = fields.Datetime(string='Processed on', readonly=True)
+    record_count = fields.Integer(string='Records', readonly=True)
+    processed_count = fields.Integer(string='Processed', readonly=True)
+    error_count = fields.Integer(string='Errors', readonly=True)
+    message = fields.Text(readonly=True)
+    attachment_id = fields.Many2one(
+        comodel_name='ir.attachment', string='File', readonly=True,
+        ondelete='set null')
+
+    @api.model
+    def _create_feed(self, backend, feed_type, content, record_count):
+        feed = self.create({
+            'backend_id': backend.id,
+            'feed_type': feed_type,
+            'record_count': record_count,
+        })
+        extension = CONTENT_TYPES[feed_type] == 'text/xml' and 'xml' or 'txt'
+        feed.attachment_id = self.env['ir.attachment'].create({
+            'name': '%s%s' % (feed_type.strip('_').lower(), feed.id),
+            'datas_fname': '%s%s.%s' % (
+                feed_type.strip('_').lower(), feed.id, extension),
+            'datas': base64.encodestring(content),
+            'res_model': self._name,
+            'res_id': feed.id,
+        })
+        return feed
+
+    @api.multi
+    def submit(self):
+        for feed in self:
+            backend = feed.backend_id
+            mws = backend._get_connection()
+            try:
+                response = mws.submit_feed(
+                    FeedType=feed.feed_type,
+                    FeedContent=base64.decodestring(
+                        feed.attachment_id.datas),
+                    content_type=CONTENT_TYPES[feed.feed_type],
+                    MarketplaceIdList=backend.marketplace.split(';'))
+            except Exception as e:
+                raise UserError(u"Amazon response:\n\n%s" % e)
+            info = response.SubmitFeedResult.FeedSubmissionInfo
+            feed.write({
+                'state': 'submitted',
+                'submission_id': info.FeedSubmissionId,
+                'date_submitted': fields.Datetime.now(),
+            })
+            _logger.info("Amazon feed %s submitted: %s records",
+                         info.FeedSubmissionId, feed.record_count)
+
+    @api.multi
+    def check_result(self):
+        """ Get the processing report of the feeds processed by Amazon,
+            the records in error are sent again by the next feed
+        """
+        feeds = self.filtered(lambda f: f.state == 'submitted')
+        for backend in feeds.mapped('backend_id'):
+            mws = backend._get_connection()
+            backend_feeds = feeds.filtered(lambda f: f.backend_id == backend)
+            for index in range(0, len(backend_feeds),
+                               FEED_STATUS_CHUNK_SIZE):
+                chunk = backend_feeds[index:index + FEED_STATUS_CHUNK_SIZE]
+                try:
+                    response = mws.get_feed_submission_list(
+                        FeedSubmissionIdList=chunk.mapped('submission_id'))
+                except Exception as e:
+                    raise UserError(u"Amazon response:\n\n%s" % e)
+                statuses = dict(
+                    (info.FeedSubmissionId, info.FeedProcessingStatus)
+                    for info in response.GetFeedSubmissionListResult
+                    .FeedSubmissionInfo)
+                for feed in chunk:
+                    status = statuses.get(feed.submission_id)
+                    if status == '_DONE_':
+                        feed._process_result(mws)
+                    elif status == '_CANCELLED_':
+                        feed._set_error(_("Feed cancelled by Amazon"))
+
+    @api.multi
+    def _process_result(self, mws):
+        self.ensure_one()
+        report = StringIO()
+        mws.get_feed_submission_result_to_file(
+            report, FeedSubmissionId=self.submission_id)
+        if CONTENT_TYPES[self.feed_type] == 'text/xml':
+            processed, errors = parse_processing_report(report.getvalue())
+        else:
+            processed, errors = parse_flat_processing_report(
+                report.getvalue())
+        vals = {
+            'date_done': fields.Datetime.now(),
+            'processed_count': processed,
+            'error_count': len(errors),
+            'message': u'\n'.join(
+                u'%s: %s' % (key or message_id, description)
+                for message_id, key, description in errors) or False,
+        }
+        if not processed and self.record_count:
+            self._set_error(vals['message'] or _("No record processed"))
+            return
+        if errors:
+            keys = [key for message_id, key, description in errors]
+            # without the SKU or order of an error, the whole feed is
+            # sent again
+            self._reset_records(None if None in keys else keys)
+        vals['state'] = 'done'
+        self.write(vals)
+
+    @api.multi
+    def _set_error(self, message):
+        self.ensure_one()
+        self._reset_records()
+        self.write({
+            'state': 'error',
+            'date_done': fields.Datetime.now(),
+            'message': message,
+        })
+
+    @api.multi
+    def _reset_records(self, keys=None):
+        """ The records of the feed, or only the ones of keys,
+            will be sent again by the next feed
+        """
+        self.ensure_one()
+        if self.feed_type == INVENTORY_FEED:
+            self.env['amazon.stock.exporter']._reset_feed(self, keys)
+        elif self.feed_type == PRICE_FEED:
+            self.env['amazon.price.exporter']._reset_feed(self, keys)
+        elif self.feed_type == FULFILLMENT_FEED:
+            self.env['amazon.shipment.exporter']._reset_feed(self, keys)
+
+    @api.model
+    def _check_results(self):
+        """ Triggered by cron """
+        self.search([('state', '=', 'submitted')]).check_result()
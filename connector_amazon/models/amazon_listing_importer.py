@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+from openerp import _, models
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import unicodecsv
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+# product-id-type of the listings report
+UPC_ID_TYPE = '3'
+EAN_ID_TYPES = (UPC_ID_TYPE, '4')
+
+
+class AmazonListingImporter(models.AbstractModel):
+    _name = 'amazon.listing.importer'
+    _description = 'Amazon Listing Importer'
+
+    def _run(self, report, meta_attachment):
+        """ Bind the SKUs of the listings report to the products:
+            the missing bindings are created, the ASIN of the existing
+            ones is updated. SKUs without product are errors of the run
+        """
+        backend = meta_attachment.amazon_backend_id
+        with backend._import_run('listing', attachment=meta_attachment) \
+                as metrics:
+            with metrics.phase('parse'):
+                listings = self._read_listings(report, backend)
+            with metrics.phase('diff'):
+                to_create, to_update, errors = self._diff_bindings(
+                    backend, listings)
+            binding_m = self.env['amazon.product']
+            with metrics.phase('bindings'):
+                binding_m._insert_bindings(to_create)
+                binding_m._update_asins(to_update)
+            metrics.incr('records', len(to_create) + len(to_update))
+            for error in errors:
+                metrics.add_error(error)
+            _logger.info(
+                "Amazon listings: %s bindings created, %s updated, "
+                "%s SKUs not bound", len(to_create), len(to_update),
+                len(errors))
+
+    def _read_listings(self, report, backend):
+        """ Return a dict sku: listing values """
+        reader = unicodecsv.DictReader(
+            report, delimiter='\t', quoting=False,
+            encoding=backend.encoding)
+        listings = {}
+        for line in reader:
+            sku = line.get('seller-sku')
+            if not sku:
+                continue
+            product_id = line.get('product-id') or None
+            id_type = line.get('product-id-type')
+            if id_type == UPC_ID_TYPE and product_id and \
+                    len(product_id) == 12:
+                # the EAN13 of a UPC
+                product_id = '0' + product_id
+            listings[sku] = {
+                'asin': line.get('asin1') or None,
+                'product_id': product_id,
+                'product_id_type': id_type,
+            }
+        return listings
+
+    def _get_bindings(self, backend):
+        """ Return a dict sku: (binding id, asin) and the set of the
+            bound products of the backend
+        """
+        self._cr.execute("""
+            SELECT id, external_id, asin, record_id FROM amazon_product
+            WHERE backend_id = %s
+            """, (backend.id,))
+        bindings = {}
+        products = set()
+        for binding_id, sku, asin, product_id in self._cr.fetchall():
+            bindings[sku] = (binding_id, asin)
+            products.add(product_id)
+        return bindings, products
+
+    def _match_products(self, listings):
+        """ Return a dict sku: product id, products are found by their
+            reference then by their EAN13 for the UPC and EAN listings
+        """
+        product_m = self.env['product.product']
+        by_code = {}
+        for product in product_m.search_read(
+                [('default_code', 'in', listings.keys())],
+                ['default_code']):
+            by_code.setdefault(product['default_code'], product['id'])
+        eans = set(values['product_id'] for sku, values in listings.items()
+                   if sku not in by_code and values['product_id'] and
+                   values['product_id_type'] in EAN_ID_TYPES)
+        by_ean = {}
+        if eans:
+            for product in product_m.search_read(
+                    [('ean13', 'in', list(eans))], ['ean13']):
+                by_ean.setdefault(product['ean13'], product['id'])
+        matches = {}
+        for sku, values in listings.items():
+            product_id = by_code.get(sku) or by_ean.get(values['product_id'])
+            if product_id:
+                matches[sku] = product_id
+        return matches
+
+    def _diff_bindings(self, backend, listings):
+        """ Return the bindings to create as (backend id, product id,
+            sku, asin), the ones to update as (binding id, asin)
+            and the error messages of the SKUs which can not be bound
+        """
+        bindings, bound_products = self._get_bindings(backend)
+        to_update = [
+            (bindings[sku][0], values['asin'])
+            for sku, values in listings.items()
+            if sku in bindings and values['asin'] and
+            values['asin'] != bindings[sku][1]]
+        new_listings = dict((sku, values) for sku, values in listings.items()
+                            if sku not in bindings)
+        matches = self._match_products(new_listings)
+        to_create = []
+        errors = []
+        for sku, values in new_listings.items():
+            product_id = matches.get(sku)
+            if not product_id:
+                errors.append(_("SKU %s: no product found") % sku)
+            elif product_id in bound_products:
+                errors.append(
+                    _("SKU %s: the product is already bound to another SKU")
+                    % sku)
+            else:
+                bound_products.add(product_id)
+                to_create.append(
+                    (backend.id, product_id, sku, values['asin']))
+        return to_create, to_update, errors
@@ -3,15 +3,19 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from openerp import models
+from openerp import fields, models
+from openerp.exceptions import Warning as UserError
+import re
 import StringIO
-from datetime import datetime
+from datetime import datetime, timedelta
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from collections import defaultdict
 from openerp.tools.translate import _
 from openerp.addons.account_move_base_import.parser.file_parser import (
     FileParser)
-from openerp.tools import ustr
+from openerp.tools import float_round, ustr
+
+from .import_run import ImportMetrics
 
 import logging
 _logger = logging.getLogger(__name__)
@@ -22,20 +26,118 @@ except (ImportError, IOError) as err:
     _logger.debug(err)
 
 
-def s2f(val):
-    if len(val) == 0:
-        return 0.0
-    val = val.replace(',', '.')
-    return float(val)
+# Date formats of the marketplaces: US, UK, JP, EU, IN
+DATE_FORMATS = [
+    (re.compile(r'^\d{4}-\d{1,2}-\d{1,2}$'), '%Y-%m-%d'),
+    (re.compile(r'^\d{4}/\d{1,2}/\d{1,2}$'), '%Y/%m/%d'),
+    (re.compile(r'^\d{1,2}\.\d{1,2}\.\d{4}$'), '%d.%m.%Y'),
+    (re.compile(r'^\d{1,2}/\d{1,2}/\d{4}$'), '%d/%m/%Y'),
+    (re.compile(r'^\d{1,2}-\d{1,2}-\d{4}$'), '%d-%m-%Y'),
+]
+DATE_REGEX = re.compile(
+    r'^\s*(?P<date>[\d./-]+)'
+    r'(?:[ T](?P<time>\d{1,2}:\d{2}(?::\d{2})?)(?:\.\d+)?)?'
+    r'\s*(?P<tz>[A-Za-z]+|[+-]\d{2}:?\d{2})?\s*$')
+# Offset in minutes of the time zones used in the reports
+TZ_OFFSETS = {
+    'UTC': 0, 'GMT': 0, 'Z': 0,
+    'PST': -480, 'PDT': -420, 'MST': -420, 'MDT': -360,
+    'CST': -360, 'CDT': -300, 'EST': -300, 'EDT': -240,
+    'BST': 60, 'CET': 60, 'CEST': 120, 'MEZ': 60, 'MESZ': 120,
+    'IST': 330, 'JST': 540, 'AEST': 600, 'AEDT': 660,
+}
+ZERO_DECIMAL_CURRENCIES = ('JPY',)
+
+
+def _parse_tz(tz):
+    if not tz:
+        return 0
+    if tz[0] in '+-':
+        sign = tz[0] == '-' and -1 or 1
+        tz = tz[1:].replace(':', '')
+        return sign * (int(tz[:2]) * 60 + int(tz[2:]))
+    if tz.upper() not in TZ_OFFSETS:
+        raise UserError(_("Unsupported time zone %s") % tz)
+    return TZ_OFFSETS[tz.upper()]
+
+
+def get_date_parser(sample):
+    """ Return a function converting the dates formatted like the sample
+        to the server datetime format (in UTC)
+    """
+    match = DATE_REGEX.match(sample or '')
+    date_format = match and next(
+        (fmt for regex, fmt in DATE_FORMATS
+         if regex.match(match.group('date'))), None)
+    if not date_format:
+        raise UserError(_("Unsupported date format %s") % sample)
+
+    def parse(date_str):
+        match = DATE_REGEX.match(date_str)
+        if not match:
+            raise UserError(_("Unsupported date format %s") % date_str)
+        date = datetime.strptime(match.group('date'), date_format)
+        time = match.group('time')
+        if time:
+            time = [int(val) for val in time.split(':')] + [0]
+            date = date.replace(hour=time[0], minute=time[1],
+                                second=time[2])
+        date -= timedelta(minutes=_parse_tz(match.group('tz')))
+        return date.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+    return parse
 
 
 def format_date(date_str):
     """ Depending of the country the date may do not have the same format"""
-    try:
-        date = datetime.strptime(date_str, '%d.%m.%Y %H:%M:%S %Z')
-    except:
-        date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S %Z')
-    return date.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+    return get_date_parser(date_str)(date_str)
+
+
+def _float(val):
+    return val and float(val) or 0.0
+
+
+class AmountParser(object):
+    """ Convert the amounts of a report to float. The decimal format is
+        detected on the first amount with a separator, then the same
+        conversion is applied to all the amounts:
+        '1234.5', '1234,5', '1.234,50', '1,234.50', '1,23,456.78'
+    """
+
+    def __init__(self, currency=None):
+        self.no_decimal = currency in ZERO_DECIMAL_CURRENCIES
+        self.convert = self._detect
+
+    def _detect(self, val):
+        separators = [char for char in val if char in ',.']
+        if not separators:
+            return _float(val)
+        last = separators[-1]
+        if separators.count(last) > 1 or self.no_decimal or (
+                len(set(separators)) == 1 and
+                len(val) - val.rindex(last) == 4):
+            # only thousands separators
+            thousands, decimal = last, None
+        else:
+            decimal = last
+            thousands = len(set(separators)) > 1 and separators[0] or None
+        self.convert = self._make_convert(
+            thousands, decimal != '.' and decimal or None)
+        return self.convert(val)
+
+    @staticmethod
+    def _make_convert(thousands, decimal):
+        if decimal and thousands:
+            return lambda val: _float(
+                val.replace(thousands, '').replace(decimal, '.'))
+        elif decimal:
+            return lambda val: _float(val.replace(decimal, '.'))
+        elif thousands:
+            return lambda val: _float(val.replace(thousands, ''))
+        return _float
+
+
+def s2f(val):
+    return AmountParser().convert(val)
 
 
 class AmazonPaymentImporter(models.AbstractModel):
@@ -46,10 +148,170 @@ class AmazonPaymentImporter(models.AbstractModel):
         _logger.info("Start to import bank Statement")
 
         backend = meta_attachment.amazon_backend_id
-        # Create bank statement line for transferts
-        backend.bank_journal_id.with_context(
-            file_name=meta_attachment.name, backend=backend)\
-            .multi_move_import(meta_attachment.datas, 'csv')
+        with backend._import_run('payment', attachment=meta_attachment) \
+                as metrics:
+            journal = backend.bank_journal_id.with_context(
+                file_name=meta_attachment.name, backend=backend)
+            parser = AmazonFlatV2Parser(journal, ftype='csv')
+            with metrics.phase('parse'):
+                parser._parse_report(report)
+            # Create bank statement line for transferts
+            return self._create_move(parser, meta_attachment, metrics)
+
+    def _create_move(self, parser, meta_attachment, metrics=None):
+        """ Same flow as the _move_import of the journal, but the lines
+            are inserted by chunks without the ORM: their constraints and
+            the balance of the move are checked once at the end
+        """
+        if metrics is None:
+            metrics = ImportMetrics()
+        journal = parser.journal
+        rows = parser.result_row_list
+        if not rows:
+            raise UserError(_("Nothing to import: the file is empty"))
+        move_vals = journal.prepare_move_vals(rows, parser)
+        move_vals.update({
+            'period_id': parser.period_id,
+            'ref': meta_attachment.name,
+        })
+        move = self.env['account.move'].create(move_vals)
+        with metrics.phase('move lines'):
+            columns = self._insert_move_lines(move, [
+                journal.prepare_move_line_vals(
+                    parser.get_move_line_vals(row), move)
+                for row in rows])
+            self.env.invalidate_all()
+            journal._write_extra_move_lines(parser, move)
+        metrics.incr('records', len(rows))
+        with metrics.phase('validation'):
+            move.line_id._validate_fields(columns)
+            move.validate()
+            move.invalidate_cache()
+            if move.line_id.filtered(lambda line: line.state != 'valid'):
+                raise UserError(
+                    _("The move of the settlement %s is not balanced")
+                    % meta_attachment.name)
+        # the settlement file is the one of the report
+        meta_attachment.write({'res_model': 'account.move',
+                               'res_id': move.id})
+        with metrics.phase('partner matching'):
+            self._set_order_partners(move)
+            move.invalidate_cache()
+        with metrics.phase('reconciliation'):
+            self._reconcile_orders(move)
+        if journal.launch_import_completion:
+            # only the lines not already completed are processed
+            with metrics.phase('completion'):
+                move.button_auto_completion()
+        journal.write_logs_after_import(move, len(rows))
+        return move
+
+    def _insert_move_lines(self, move, lines, chunk_size=1000):
+        """ Insert the lines of the move by chunks without the ORM, which
+            creates and checks them one by one. The amounts are rounded
+            like the ORM does. Return the inserted columns
+        """
+        move_line_m = self.env['account.move.line']
+        move_line_m.check_access_rights('create')
+        move.check_access_rule('write')
+        digits = self.env['decimal.precision'].precision_get('Account')
+        now = fields.Datetime.now()
+        # values of the lines not given by the journal
+        shared_vals = {
+            'date': move.date,
+            'ref': move.ref,
+            'company_id': move.journal_id.company_id.id,
+            'state': 'draft',
+            'blocked': False,
+            'centralisation': 'normal',
+            'amount_currency': 0.0,
+            'date_created': move.date,
+            'create_uid': self._uid,
+            'create_date': now,
+            'write_uid': self._uid,
+            'write_date': now,
+        }
+        rows = []
+        for vals in lines:
+            row = dict(shared_vals, **vals)
+            row['move_id'] = move.id
+            for name in ('debit', 'credit'):
+                row[name] = float_round(
+                    row.get(name) or 0.0, precision_digits=digits)
+            rows.append(row)
+        columns = sorted(
+            name for name in set().union(*rows)
+            if name in move_line_m._fields and
+            move_line_m._fields[name].store)
+        booleans = set(name for name in columns
+                       if move_line_m._fields[name].type == 'boolean')
+        for index in range(0, len(rows), chunk_size):
+            chunk = rows[index:index + chunk_size]
+            self._cr.execute(
+                "INSERT INTO account_move_line (%s) VALUES %s" % (
+                    ', '.join(columns), ', '.join(['%s'] * len(chunk))),
+                [tuple(row.get(name) if row.get(name) is not False or
+                       name in booleans else None for name in columns)
+                 for row in chunk])
+        return columns
+
+    def _set_order_partners(self, move):
+        """ Lines of the orders take the partner of the receivable lines
+            of their invoices, found by amazon order id. The orders
+            invoiced to several partners are left to the completion
+        """
+        self._cr.execute("""
+            UPDATE account_move_line AS line
+            SET partner_id = invoice_line.partner_id,
+                already_completed = true
+            FROM (
+                SELECT amazon_order_id, account_id,
+                    min(partner_id) AS partner_id
+                FROM account_move_line
+                WHERE amazon_order_id IN (
+                        SELECT amazon_order_id FROM account_move_line
+                        WHERE move_id = %(move_id)s
+                            AND amazon_order_id IS NOT NULL)
+                    AND move_id != %(move_id)s
+                    AND partner_id IS NOT NULL
+                GROUP BY amazon_order_id, account_id
+                HAVING count(DISTINCT partner_id) = 1
+                ) AS invoice_line
+            WHERE line.move_id = %(move_id)s
+                AND line.partner_id IS NULL
+                AND invoice_line.amazon_order_id = line.amazon_order_id
+                AND invoice_line.account_id = line.account_id
+            """, {'move_id': move.id})
+        _logger.info("%s settlement lines matched with their order",
+                     self._cr.rowcount)
+
+    def _reconcile_orders(self, move):
+        """ Reconcile the lines of the settlement with the open
+            receivable lines of the same orders, unless the order
+            has several partners
+        """
+        self._cr.execute("""
+            SELECT array_agg(DISTINCT line.id)
+            FROM account_move_line AS line
+            JOIN account_move_line AS settlement_line
+                ON settlement_line.amazon_order_id = line.amazon_order_id
+                AND settlement_line.account_id = line.account_id
+            WHERE settlement_line.move_id = %s
+                AND line.reconcile_id IS NULL
+                AND line.state = 'valid'
+            GROUP BY line.amazon_order_id
+            HAVING bool_or(line.move_id != %s)
+                AND count(DISTINCT line.partner_id) <= 1
+            """, (move.id, move.id))
+        move_line_m = self.env['account.move.line']
+        for line_ids, in self._cr.fetchall():
+            lines = move_line_m.browse(line_ids)
+            try:
+                with self._cr.savepoint():
+                    lines.reconcile_partial('manual')
+            except Exception as e:
+                _logger.warning("Lines %s can not be reconciled: %s",
+                                line_ids, e)
 
 
 class AmazonFlatV2Parser(FileParser):
@@ -62,6 +324,7 @@ class AmazonFlatV2Parser(FileParser):
         # set self.env for later ORM searches
         self.env = journal.env
         self.backend = self.env.context['backend']
+        self.journal_id = journal.id
         super(AmazonFlatV2Parser, self).__init__(
             journal, ftype=ftype,
             extra_fields=conversion_dict,
@@ -82,6 +345,54 @@ class AmazonFlatV2Parser(FileParser):
         else:
             result[line['amount-description']] += s2f(line['amount'])
 
+    def _aggregate_rows(self, rows, header, amounts=None):
+        """ Same result as _merge_line, computed from the rows of
+            unicodecsv.reader: only the needed columns are read and
+            the sums are grouped without a dict per row
+        """
+        if amounts is None:
+            amounts = AmountParser()
+        index = dict((name, pos) for pos, name in enumerate(header))
+        ttype_pos = index['transaction-type']
+        order_pos = index['order-id']
+        atype_pos = index['amount-type']
+        description_pos = index['amount-description']
+        amount_pos = index['amount']
+        result = defaultdict(float)
+        result.update({
+            'Order': defaultdict(lambda: defaultdict(float)),
+            'Refund': defaultdict(lambda: defaultdict(float)),
+            })
+        orders = {'Order': {}, 'Refund': {}}
+        order_types = ('ItemPrice', 'Promotion')
+        others = {}
+        for row in rows:
+            if not row:
+                continue
+            amount = amounts.convert(row[amount_pos])
+            ttype = row[ttype_pos]
+            if ttype in orders and row[atype_pos] in order_types:
+                sums = orders[ttype]
+                key = row[order_pos]
+            else:
+                sums = others
+                key = row[description_pos]
+            if key in sums:
+                sums[key] += amount
+            else:
+                sums[key] = 0.0 + amount
+                # keep the keys in the order of _merge_line
+                if sums is others:
+                    result[key]
+                else:
+                    result[ttype][key]
+        for key, amount in others.iteritems():
+            result[key] = amount
+        for ttype in orders:
+            for order_ref, amount in orders[ttype].iteritems():
+                result[ttype][order_ref]['amount'] = amount
+        return result
+
     def _merge_line(self, lines):
         result = defaultdict(float)
         result.update({
@@ -94,45 +405,55 @@ class AmazonFlatV2Parser(FileParser):
 
     def _convert_parsed_to_row(self, parsed):
         res = []
+        # read once the values shared by the rows
+        sale_prefix = self.backend.sale_prefix
+        receivable_account_id = self.journal.receivable_account_id.id
+        commission_account_id = self.journal.commission_account_id.id
+        partner_id = self.journal.partner_id.id
         for key, vals in parsed.items():
             if key in ['Order', 'Refund']:
                 for order_name, order_vals in vals.items():
                     res.append({
-                        'label': '%s%s' % (
-                            self.backend.sale_prefix, order_name),
+                        'label': '%s%s' % (sale_prefix, order_name),
                         'amount': order_vals['amount'],
-                        'account_id': self.journal.receivable_account_id.id,
+                        'account_id': receivable_account_id,
+                        'amazon_order_id': order_name,
                         })
             else:
                 res.append({
                     'label': key,
                     'amount': vals,
-                    'account_id': self.journal.commission_account_id.id,
-                    'partner_id': self.journal.partner_id.id,
+                    'account_id': commission_account_id,
+                    'partner_id': partner_id,
                     })
         return res
 
     def _parse(self, *args, **kwargs):
-        self.result_row_list = []
-        tmpfile = StringIO.StringIO()
-        tmpfile.write(self.filebuffer)
-        tmpfile.seek(0)
+        # the StringIO reads the buffer without copying it
+        return self._parse_report(StringIO.StringIO(self.filebuffer))
 
-        reader = unicodecsv.DictReader(
-            tmpfile, delimiter='\t', quoting=False,
+    def _parse_report(self, report):
+        """ Aggregate the rows while they are read from the report
+            file object, the file is never loaded in memory
+        """
+        self.result_row_list = []
+        reader = unicodecsv.reader(
+            report, delimiter='\t', quoting=False,
             encoding='ISO-8859-15')
 
-        first_line = reader.next()
+        header = reader.next()
+        first_line = dict(zip(header, reader.next()))
+        amounts = AmountParser(first_line.get('currency'))
         self.move_date = format_date(first_line['settlement-end-date'])
         self.period_id = self.env['account.period'].find(dt=self.move_date).id
         self.result_row_list.append({
             'label': _('Internal bank transfers'),
-            'amount': -s2f(first_line['total-amount']),
+            'amount': -amounts.convert(first_line['total-amount']),
             'account_id': self.journal.default_debit_account_id.id,
             'period_id': self.period_id,
             'partner_id': self.journal.partner_id.id,
             })
-        result = self._merge_line(reader)
+        result = self._aggregate_rows(reader, header, amounts=amounts)
         self.result_row_list += self._convert_parsed_to_row(result)
         return True
 
@@ -144,7 +465,8 @@ class AmazonFlatV2Parser(FileParser):
             'credit': amount > 0.0 and amount or 0.0,
             'debit': amount < 0.0 and -amount or 0.0,
             'period_id': self.period_id,
-            'journal_id': self.journal.id,
+            'journal_id': self.journal_id,
             'already_completed': bool(line.get('partner_id')),
             'partner_id': line.get('partner_id') or False,
+            'amazon_order_id': line.get('amazon_order_id') or False,
             }
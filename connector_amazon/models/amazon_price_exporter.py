@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+from xml.sax.saxutils import escape
+
+from openerp import api, models
+from openerp.tools import float_compare
+
+from .amazon_feed import PRICE_FEED, xml_feed
+
+_logger = logging.getLogger(__name__)
+
+
+class AmazonPriceExporter(models.AbstractModel):
+    _name = 'amazon.price.exporter'
+    _description = 'Amazon Price Exporter'
+
+    @api.model
+    def _export(self, backend):
+        """ Send the prices which changed since the last feed,
+            return the submitted feed or None when nothing changed
+        """
+        rows = self._get_price_deltas(backend)
+        if not rows:
+            _logger.info("Amazon prices of %s are up to date", backend.name)
+            return None
+        feed = self.env['amazon.feed']._create_feed(
+            backend, PRICE_FEED, self._build_feed(backend, rows), len(rows))
+        self.env['amazon.product']._bulk_write(
+            ['last_price_sent', 'price_feed_id'],
+            [(binding_id, price, feed.id)
+             for binding_id, sku, price in rows])
+        feed.submit()
+        return feed
+
+    @api.model
+    def _get_prices(self, backend, product_ids):
+        """ Return a dict product id: price of the backend pricelist,
+            computed for all the products at once
+        """
+        pricelist = backend.pricelist_id
+        products = self.env['product.product'].browse(product_ids)
+        prices = pricelist.price_get_multi(
+            [(product, 1.0, False) for product in products])
+        return dict((product_id, prices[product_id][pricelist.id])
+                    for product_id in product_ids)
+
+    @api.model
+    def _get_price_deltas(self, backend):
+        """ Return the bindings to send as (binding id, sku, price):
+            the ones which price changed or was never sent.
+            Products without price are not sent
+        """
+        self._cr.execute("""
+            SELECT id, external_id, record_id, last_price_sent
+            FROM amazon_product
+            WHERE backend_id = %s AND external_id IS NOT NULL
+            """, (backend.id,))
+        bindings = self._cr.fetchall()
+        prices = self._get_prices(
+            backend, list(set(binding[2] for binding in bindings)))
+        currency = backend.pricelist_id.currency_id
+        rows = []
+        for binding_id, sku, product_id, last_price in bindings:
+            price = currency.round(prices.get(product_id) or 0.0)
+            if float_compare(price, 0.0,
+                             precision_rounding=currency.rounding) <= 0:
+                continue
+            if last_price is None or float_compare(
+                    price, last_price,
+                    precision_rounding=currency.rounding):
+                rows.append((binding_id, sku, price))
+        return rows
+
+    @api.model
+    def _build_feed(self, backend, rows):
+        currency = escape(backend.pricelist_id.currency_id.name,
+                          {'"': '&quot;'})
+        return xml_feed(backend.merchant, 'Price', (
+            u'<Price><SKU>%s</SKU><StandardPrice currency="%s">%.2f'
+            u'</StandardPrice></Price>' % (escape(sku), currency, price)
+            for binding_id, sku, price in rows))
+
+    @api.model
+    def _reset_feed(self, feed, skus=None):
+        """ The prices of the feed are sent again by the next one """
+        self.env['amazon.product']._reset_sent(
+            'last_price_sent', 'price_feed_id', feed, skus=skus)
@@ -4,10 +4,13 @@
 # @author David BEAL <david.beal@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-import StringIO
 import logging
+from itertools import islice
 
-from openerp import models
+from openerp import _, models
+from openerp.exceptions import Warning as UserError
+
+from .import_run import get_metrics
 
 _logger = logging.getLogger(__name__)
 
@@ -23,32 +26,125 @@ class AmazonSaleImporter(models.AbstractModel):
 
     def _run(self, report, meta_attachment):
         """ Process the report and generate the sale order
+            report: file object read line by line, sales are created
+            by chunks while the file is parsed
+        """
+        backend = meta_attachment.amazon_backend_id
+        with backend._import_run('sale', attachment=meta_attachment) \
+                as metrics:
+            if backend.sale_import_jobs:
+                with metrics.phase('split'):
+                    return self._split_in_jobs(report, meta_attachment)
+            report.readline()  # we pass the file header
+            errors = self._import_lines(
+                report, meta_attachment, metrics=metrics)
+            if errors:
+                raise UserError(u'\n'.join(errors))
+
+    def _import_lines(self, lines, meta_attachment, lock=False,
+                      metrics=None):
+        """ Import the sales of these report lines (without header)
+            lock: serialize the customer creation with the other
+            workers importing the same report
+            metrics: ImportMetrics of the run
+            Return the error messages of the failed sales
         """
         backend = meta_attachment.amazon_backend_id
-        file = StringIO.StringIO()
-        file.write(report)
-        file.seek(0)
         reader = unicodecsv.DictReader(
-            file, fieldnames=self._get_header_fieldnames(),
+            lines, fieldnames=self._get_header_fieldnames(),
             delimiter='\t', quoting=False,
             encoding=backend.encoding)
-        reader.next()  # we pass the file header
-        sales = self._extract_infos(reader)
-        file.close()
-        for item in sales:
-            sale = sales[item]
+        errors = []
+        sales = self._iter_sales(reader, errors=errors)
+        size = backend.sale_import_batch_size or 1
+        cache = {'orders': set(), 'metrics': metrics}
+        metrics = get_metrics(cache)
+        while True:
+            with metrics.phase('parse'):
+                chunk = list(islice(sales, size))
+            if not chunk:
+                break
+            emails = lock and [sale['partner']['email'] for sale in chunk]
+            with backend._lock_customers(emails or []):
+                errors += self._import_chunk(chunk, meta_attachment, cache)
+                # Warning, we volontary commit here the sales created
+                # this avoid loosing them if an other chunk fails
+                with metrics.phase('commit'):
+                    self._cr.commit()
+        return errors
+
+    def _split_in_jobs(self, report, meta_attachment):
+        """ Cut the report in chunks of whole orders,
+            each one is imported by a job
+        """
+        chunks = meta_attachment.amazon_chunk_ids
+        if chunks:
+            # the report stays pending while its chunks run, so the
+            # scheduler runs it again: only the failed chunks are retried
+            failed = chunks.filtered(lambda chunk: chunk.state == 'failed')
+            failed.write({'state': 'pending', 'message': False})
+            failed._enqueue()
+            return
+        backend = meta_attachment.amazon_backend_id
+        size = backend.sale_import_chunk_size or 1
+        chunk_m = self.env['amazon.report.chunk']
+        position = len(report.readline())  # we pass the file header
+        start, count, order = position, 0, None
+        sequence = 0
+        for line in iter(report.readline, ''):
+            line_order = line.split('\t', 1)[0]
+            if line_order != order:
+                if count == size:
+                    sequence += 1
+                    chunk_m.create({
+                        'attachment_id': meta_attachment.id,
+                        'sequence': sequence,
+                        'offset_start': start,
+                        'offset_stop': position,
+                        'order_count': count,
+                    })
+                    start, count = position, 0
+                order = line_order
+                count += 1
+            position += len(line)
+        if count:
+            chunk_m.create({
+                'attachment_id': meta_attachment.id,
+                'sequence': sequence + 1,
+                'offset_start': start,
+                'offset_stop': position,
+                'order_count': count,
+            })
+        meta_attachment.amazon_chunk_ids._enqueue()
+
+    def _import_chunk(self, sales, meta_attachment, cache):
+        """ Create the sales not imported yet,
+            return the error messages of the failed ones
+        """
+        backend = meta_attachment.amazon_backend_id
+        metrics = get_metrics(cache)
+        with metrics.phase('prepare cache'):
+            cache['orders'] |= backend._get_existing_sale_names(
+                [sale['auto_insert']['origin'] for sale in sales])
+        to_create = []
+        for sale in sales:
             sale['auto_insert'].update({
                 'external_origin': 'ir.attachment.metadata,%s'
                 % meta_attachment.id,
                 'workflow_process_id': backend.workflow_process_id.id,
             })
             if backend._should_skip_sale_order(
-                    sale['auto_insert']['origin'], is_fba=False):
+                    sale['auto_insert']['origin'], is_fba=False,
+                    cache=cache):
                 _logger.debug(
                     "Order %s already have been imported, skip it",
                     sale['auto_insert']['origin'])
                 continue
-            backend._create_sale(sales[item])
+            to_create.append(sale)
+        # products and partners of the chunk are searched at once
+        with metrics.phase('prepare cache'):
+            backend._prepare_import_cache(to_create, cache=cache)
+        return backend._create_sales(to_create, cache=cache)
 
     def _get_header_fieldnames(self):
         return [
@@ -63,42 +159,65 @@ class AmazonSaleImporter(models.AbstractModel):
             'delivery-time-zone', 'delivery-Instructions', 'sales-channel',
         ]
 
-    def _extract_infos(self, reader):
-        sales = {}
+    def _iter_sales(self, reader, errors=None):
+        """ Yield the sales one by one: Amazon reports are sorted by order
+            so the lines of an order are consecutive.
+            The lines found after the sale of their order was yielded
+            can not be imported, they are reported in errors
+        """
+        if errors is None:
+            errors = []
+        sale = None
+        origins = set()
+        late_origins = set()
         for line in reader:
             if not line.get('order-item-id'):
                 continue
-            if line['order-id'] in sales:
-                sales[line['order-id']]['lines'].append(
-                    self._get_sale_line(line))
-            else:
-                sales[line['order-id']] = {
-                    'auto_insert': {
-                        # these values will be inserted
-                        # if matching field exists in the ERP
-                        'origin': line['order-id'],
-                        'date_order': line['purchase-date'],
-                    },
-                    'partner': {
-                        'email': line['buyer-email'],
-                        'name': line['buyer-name'],
-                        'phone': line['buyer-phone-number'],
-                    },
-                    'part_ship': {
-                        'name': line['recipient-name'],
-                        'type': 'delivery',
-                        'phone': line['ship-phone-number'],
-                        'street': line['ship-address-1'],
-                        'street2': line['ship-address-2'],
-                        'street3': line['ship-address-3'],
-                        'city': line['ship-city'],
-                        'state': line['ship-state'],
-                        'zip': line['ship-postal-code'],
-                        'country': line['ship-country'],
-                    },
-                    'lines': [self._get_sale_line(line)],
-                }
-        return sales
+            if sale and sale['auto_insert']['origin'] == line['order-id']:
+                sale['lines'].append(self._get_sale_line(line))
+                continue
+            if line['order-id'] in origins:
+                if line['order-id'] not in late_origins:
+                    late_origins.add(line['order-id'])
+                    errors.append(
+                        _("Order %s: lines are not consecutive in the "
+                          "report, the sale is incomplete")
+                        % line['order-id'])
+                continue
+            if sale:
+                yield sale
+            origins.add(line['order-id'])
+            sale = self._prepare_sale(line)
+        if sale:
+            yield sale
+
+    def _prepare_sale(self, line):
+        return {
+            'auto_insert': {
+                # these values will be inserted
+                # if matching field exists in the ERP
+                'origin': line['order-id'],
+                'date_order': line['purchase-date'],
+            },
+            'partner': {
+                'email': line['buyer-email'],
+                'name': line['buyer-name'],
+                'phone': line['buyer-phone-number'],
+            },
+            'part_ship': {
+                'name': line['recipient-name'],
+                'type': 'delivery',
+                'phone': line['ship-phone-number'],
+                'street': line['ship-address-1'],
+                'street2': line['ship-address-2'],
+                'street3': line['ship-address-3'],
+                'city': line['ship-city'],
+                'state': line['ship-state'],
+                'zip': line['ship-postal-code'],
+                'country': line['ship-country'],
+            },
+            'lines': [self._get_sale_line(line)],
+        }
 
     def _get_sale_line(self, line):
         return {
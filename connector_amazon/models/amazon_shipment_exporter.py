@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+from openerp import api, fields, models
+
+from .amazon_feed import FLAT_FILE_ENCODING, FULFILLMENT_FEED
+
+_logger = logging.getLogger(__name__)
+
+FULFILLMENT_HEADER = [
+    'order-id', 'order-item-id', 'quantity', 'ship-date', 'carrier-code',
+    'carrier-name', 'tracking-number', 'ship-method',
+]
+
+
+class AmazonShipmentExporter(models.AbstractModel):
+    _name = 'amazon.shipment.exporter'
+    _description = 'Amazon Shipment Exporter'
+
+    @api.model
+    def _export(self, backend):
+        """ Confirm to Amazon the orders delivered since the last feed,
+            return the submitted feed or None when nothing was delivered
+        """
+        shipments = self._get_shipments(backend)
+        if not shipments:
+            _logger.info("No Amazon shipment to confirm for %s",
+                         backend.name)
+            return None
+        feed = self.env['amazon.feed']._create_feed(
+            backend, FULFILLMENT_FEED, self._build_feed(backend, shipments),
+            len(shipments))
+        self._cr.execute("""
+            UPDATE stock_picking SET amazon_feed_id = %s WHERE id IN %s
+            """, (feed.id, tuple(picking_id for shipment in shipments
+                                 for picking_id in shipment['picking_ids'])))
+        self.env['stock.picking'].invalidate_cache(['amazon_feed_id'])
+        feed.submit()
+        return feed
+
+    @api.model
+    def _get_shipments(self, backend):
+        """ Return the Amazon orders (FBA excluded) which deliveries are
+            all done or cancelled, with pickings delivered since the last
+            feed: one shipment by order, with the carrier and tracking
+            number of the last picking
+        """
+        self._cr.execute("""
+            SELECT so.amazon_order_id, picking.id, picking.date_done,
+                carrier.amazon_carrier_code, carrier.name,
+                picking.carrier_tracking_ref
+            FROM stock_picking picking
+            JOIN stock_picking_type picking_type
+                ON picking_type.id = picking.picking_type_id
+            JOIN sale_order so ON so.procurement_group_id = picking.group_id
+            LEFT JOIN delivery_carrier carrier
+                ON carrier.id = picking.carrier_id
+            WHERE so.amazon_backend_id = %(backend)s
+                AND so.is_amazon_fba IS NOT TRUE
+                AND so.amazon_order_id IS NOT NULL
+                AND picking_type.code = 'outgoing'
+                AND picking.state = 'done'
+                AND picking.amazon_feed_id IS NULL
+                AND picking.date_done >= %(date_from)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM stock_picking pending
+                    WHERE pending.group_id = picking.group_id
+                        AND pending.state NOT IN ('done', 'cancel'))
+            ORDER BY so.amazon_order_id, picking.date_done DESC,
+                picking.id DESC
+            """, {'backend': backend.id,
+                  'date_from': backend.export_shipment_from})
+        shipments = []
+        for (order_id, picking_id, date_done, carrier_code, carrier_name,
+                tracking_ref) in self._cr.fetchall():
+            if shipments and shipments[-1]['order_id'] == order_id:
+                shipments[-1]['picking_ids'].append(picking_id)
+                continue
+            shipments.append({
+                'order_id': order_id,
+                'picking_ids': [picking_id],
+                'date': date_done,
+                'carrier_code': (carrier_code or
+                                 carrier_name and 'Other' or ''),
+                'carrier_name': not carrier_code and carrier_name or '',
+                'tracking_ref': tracking_ref or '',
+            })
+        return shipments
+
+    @api.model
+    def _build_feed(self, backend, shipments):
+        """ Flat file without order items: the whole order is confirmed """
+        lines = [u'\t'.join(FULFILLMENT_HEADER)]
+        for shipment in shipments:
+            ship_date = fields.Datetime.from_string(shipment['date'])
+            lines.append(u'\t'.join([
+                shipment['order_id'], u'', u'',
+                ship_date.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+                shipment['carrier_code'],
+                shipment['carrier_name'],
+                shipment['tracking_ref'], u'',
+            ]))
+        return (u'\n'.join(lines) + u'\n').encode(
+            FLAT_FILE_ENCODING, 'replace')
+
+    @api.model
+    def _reset_feed(self, feed, order_ids=None):
+        """ The orders of the feed are confirmed again by the next one """
+        if order_ids is not None and not order_ids:
+            return
+        query = """
+            UPDATE stock_picking SET amazon_feed_id = NULL
+            WHERE amazon_feed_id = %s"""
+        params = [feed.id]
+        if order_ids is not None:
+            query += """ AND group_id IN (
+                SELECT procurement_group_id FROM sale_order
+                WHERE amazon_order_id IN %s)"""
+            params.append(tuple(order_ids))
+        self._cr.execute(query, params)
+        self.env['stock.picking'].invalidate_cache(['amazon_feed_id'])
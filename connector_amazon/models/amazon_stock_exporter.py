@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+from xml.sax.saxutils import escape
+
+from openerp import api, models
+
+from .amazon_feed import INVENTORY_FEED, xml_feed
+
+_logger = logging.getLogger(__name__)
+
+
+class AmazonStockExporter(models.AbstractModel):
+    _name = 'amazon.stock.exporter'
+    _description = 'Amazon Stock Exporter'
+
+    @api.model
+    def _export(self, backend):
+        """ Send the quantities which changed since the last feed,
+            return the submitted feed or None when nothing changed
+        """
+        rows = self._get_stock_deltas(backend)
+        if not rows:
+            _logger.info("Amazon stock of %s is up to date", backend.name)
+            return None
+        feed = self.env['amazon.feed']._create_feed(
+            backend, INVENTORY_FEED, self._build_feed(backend, rows),
+            len(rows))
+        self.env['amazon.product']._bulk_write(
+            ['last_qty_sent', 'stock_feed_id'],
+            [(binding_id, qty, feed.id) for binding_id, sku, qty in rows])
+        feed.submit()
+        return feed
+
+    @api.model
+    def _get_available_qties(self, backend):
+        """ Return a dict product id: unreserved quantity in the stock
+            of the warehouse, read in one grouped query
+        """
+        warehouse = backend._get_stock_warehouse()
+        groups = self.env['stock.quant'].read_group(
+            [('location_id', 'child_of', warehouse.lot_stock_id.id),
+             ('reservation_id', '=', False)],
+            ['product_id', 'qty'], ['product_id'])
+        return dict((group['product_id'][0], group['qty'])
+                    for group in groups)
+
+    @api.model
+    def _get_stock_deltas(self, backend):
+        """ Return the bindings to send as (binding id, sku, quantity):
+            the ones which quantity changed or was never sent
+        """
+        qties = self._get_available_qties(backend)
+        self._cr.execute("""
+            SELECT id, external_id, record_id, last_qty_sent
+            FROM amazon_product
+            WHERE backend_id = %s AND external_id IS NOT NULL
+            """, (backend.id,))
+        rows = []
+        for binding_id, sku, product_id, last_qty in self._cr.fetchall():
+            qty = max(int(qties.get(product_id, 0)), 0)
+            if qty != last_qty:
+                rows.append((binding_id, sku, qty))
+        return rows
+
+    @api.model
+    def _build_feed(self, backend, rows):
+        return xml_feed(backend.merchant, 'Inventory', (
+            u"<Inventory><SKU>%s</SKU><Quantity>%s</Quantity></Inventory>"
+            % (escape(sku), qty) for binding_id, sku, qty in rows))
+
+    @api.model
+    def _reset_feed(self, feed, skus=None):
+        """ The quantities of the feed are sent again by the next one """
+        self.env['amazon.product']._reset_sent(
+            'last_qty_sent', 'stock_feed_id', feed, skus=skus)
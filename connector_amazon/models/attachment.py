@@ -3,12 +3,14 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from openerp import fields, models
+from openerp import api, fields, models
 import base64
+import StringIO
 
 SUPPORTED_REPORT = {
     '_GET_FLAT_FILE_ORDERS_DATA_': 'Amazon Order',
     '_GET_V2_SETTLEMENT_REPORT_DATA_FLAT_FILE_V2_': 'Amazon Bank Statement',
+    '_GET_MERCHANT_LISTINGS_DATA_': 'Amazon Listings',
 }
 
 
@@ -19,15 +21,73 @@ class IrAttachmentMetadata(models.Model):
         comodel_name='amazon.backend', string='Amazon Backend')
     amazon_report_id = fields.Char(string="Amazon Report")
     file_type = fields.Selection(selection_add=SUPPORTED_REPORT.items())
+    amazon_chunk_ids = fields.One2many(
+        comodel_name='amazon.report.chunk', inverse_name='attachment_id',
+        string='Amazon Chunks', readonly=True)
 
     _sql_constraints = [
         ('uniq_report_per_backend',
          'unique(amazon_backend_id, amazon_report_id)',
          'Amazon Report must be uniq per backend')]
 
+    def _open_report(self):
+        """ Return a file object on the report: the file of the filestore
+            is read directly instead of decoding the whole datas
+        """
+        if self.store_fname:
+            return open(
+                self.env['ir.attachment']._full_path(self.store_fname), 'rb')
+        return StringIO.StringIO(base64.b64decode(self.datas or ''))
+
+    @api.multi
+    def write(self, vals):
+        """ A report imported by chunk jobs is done when all its chunks
+            are, not when the jobs are enqueued
+        """
+        if vals.get('state') != 'done':
+            return super(IrAttachmentMetadata, self).write(vals)
+        for attachment in self:
+            state = 'done'
+            if attachment.amazon_chunk_ids:
+                state = attachment._get_chunk_state()
+            super(IrAttachmentMetadata, attachment).write(
+                dict(vals, state=state))
+        return True
+
+    @api.multi
+    def _get_chunk_state(self):
+        self.ensure_one()
+        states = set(self.amazon_chunk_ids.mapped('state'))
+        if 'failed' in states:
+            return 'failed'
+        elif 'pending' in states:
+            return 'pending'
+        return 'done'
+
+    @api.multi
+    def _update_chunk_state(self):
+        """ Called by the chunk jobs when they end """
+        for attachment in self:
+            state = attachment._get_chunk_state()
+            messages = attachment.amazon_chunk_ids.filtered(
+                lambda chunk: chunk.state == 'failed').mapped('message')
+            attachment.write({
+                'state': state,
+                'state_message': u'\n'.join(
+                    message for message in messages if message) or False,
+            })
+
     def _run(self):
-        report = base64.b64decode(self.datas)
-        if self.file_type == '_GET_FLAT_FILE_ORDERS_DATA_':
-            self.env['amazon.sale.importer']._run(report, self)
-        elif self.file_type == '_GET_V2_SETTLEMENT_REPORT_DATA_FLAT_FILE_V2_':
-            self.env['amazon.payment.importer']._run(report, self)
+        if self.file_type not in SUPPORTED_REPORT:
+            return
+        report = self._open_report()
+        try:
+            if self.file_type == '_GET_FLAT_FILE_ORDERS_DATA_':
+                self.env['amazon.sale.importer']._run(report, self)
+            elif self.file_type == \
+                    '_GET_V2_SETTLEMENT_REPORT_DATA_FLAT_FILE_V2_':
+                self.env['amazon.payment.importer']._run(report, self)
+            elif self.file_type == '_GET_MERCHANT_LISTINGS_DATA_':
+                self.env['amazon.listing.importer']._run(report, self)
+        finally:
+            report.close()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+from openerp import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import iso8601
+except ImportError:
+    _logger.debug('Cannot `import iso8601` library.')
+
+
+class AmazonImportCheckpoint(models.Model):
+    _name = 'amazon.import.checkpoint'
+    _description = 'Amazon Import Checkpoint'
+
+    backend_id = fields.Many2one(
+        comodel_name='amazon.backend', string='Backend', required=True,
+        ondelete='cascade')
+    channel = fields.Selection(
+        selection=[
+            ('fba', 'FBA Sales'),
+            ('report', 'Reports'),
+        ], required=True)
+    line_ids = fields.One2many(
+        comodel_name='amazon.import.checkpoint.line',
+        inverse_name='checkpoint_id', string='Processed Documents')
+
+    _sql_constraints = [
+        ('channel_uniq', 'unique(backend_id, channel)',
+         'Only one checkpoint by backend and channel.')]
+
+    @api.multi
+    def _get_processed_ids(self):
+        """ Return the Amazon ids already processed since the
+            last import start date
+        """
+        self.ensure_one()
+        lines = self.env['amazon.import.checkpoint.line'].search_read(
+            [('checkpoint_id', '=', self.id)], ['external_id'])
+        return set(line['external_id'] for line in lines)
+
+    @api.multi
+    def _mark_processed(self, external_id, date):
+        """ Remember a processed document, to be committed by the caller
+            date: Amazon update date of the document (iso 8601)
+        """
+        self.ensure_one()
+        date = fields.Datetime.to_string(iso8601.parse_date(date))
+        self.env['amazon.import.checkpoint.line'].create({
+            'checkpoint_id': self.id,
+            'external_id': external_id,
+            'date': date,
+        })
+
+    @api.multi
+    def _forget_before(self, date):
+        """ Documents updated before the date will not be returned anymore
+            by Amazon as the next import starts from it
+            date: string in the server datetime format
+        """
+        self.ensure_one()
+        self.env['amazon.import.checkpoint.line'].search([
+            ('checkpoint_id', '=', self.id),
+            ('date', '<', date),
+        ]).unlink()
+
+
+class AmazonImportCheckpointLine(models.Model):
+    _name = 'amazon.import.checkpoint.line'
+    _description = 'Amazon Import Checkpoint Line'
+
+    checkpoint_id = fields.Many2one(
+        comodel_name='amazon.import.checkpoint', string='Checkpoint',
+        required=True, ondelete='cascade', index=True)
+    external_id = fields.Char(string='Amazon Id', required=True, index=True)
+    date = fields.Datetime(string='Amazon Update', index=True)
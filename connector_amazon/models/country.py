@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import re
+import unicodedata
+
+from openerp import api, models, tools
+
+# Spellings used by Amazon buyers which match neither the name
+# nor the code of the state: {country code: {normalized name: state code}}
+STATE_ALIASES = {
+    'US': {
+        'washingtondc': 'DC',
+        'districtofcolumbia': 'DC',
+        'calif': 'CA',
+        'mass': 'MA',
+        'penn': 'PA',
+        'wash': 'WA',
+    },
+    'CA': {
+        'pei': 'PE',
+        'newfoundland': 'NL',
+    },
+}
+
+
+def normalize_state_name(name):
+    """ Lower ascii name without accent, space nor punctuation:
+        'Île-de-France' -> 'iledefrance', 'N.Y.' -> 'ny'
+    """
+    if not name:
+        return ''
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = name.encode('ascii', 'ignore').lower()
+    return re.sub(r'[^a-z0-9]', '', name)
+
+
+class ResCountry(models.Model):
+    _inherit = 'res.country'
+
+    @tools.ormcache(skiparg=1)
+    def _amazon_get_lookup_table(self):
+        """ Country and state ids by code and normalized name, kept in
+            the registry cache and cleared when a country or a state
+            changes. The returned dict must not be modified
+        """
+        countries = {}
+        states = {}
+        self._cr.execute("SELECT id, code FROM res_country")
+        for country_id, code in self._cr.fetchall():
+            if code:
+                countries[code.upper()] = country_id
+        self._cr.execute(
+            "SELECT id, country_id, code, name FROM res_country_state")
+        codes_by_country = {}
+        for state_id, country_id, code, name in self._cr.fetchall():
+            codes_by_country.setdefault(country_id, {})[code] = state_id
+            for key in (normalize_state_name(code),
+                        normalize_state_name(name)):
+                if key:
+                    states.setdefault((country_id, key), state_id)
+        for country_code, aliases in STATE_ALIASES.items():
+            country_id = countries.get(country_code)
+            state_codes = codes_by_country.get(country_id, {})
+            for alias, state_code in aliases.items():
+                if state_code in state_codes:
+                    states.setdefault(
+                        (country_id, alias), state_codes[state_code])
+        return {'countries': countries, 'states': states}
+
+    @api.model
+    def _amazon_get_country_id(self, country_code):
+        if not country_code:
+            return False
+        table = self._amazon_get_lookup_table()
+        return table['countries'].get(country_code.upper(), False)
+
+    @api.model
+    def _amazon_get_state_id(self, country_id, state_name):
+        """ State is only searched in the country of the address """
+        key = normalize_state_name(state_name)
+        if not country_id or not key:
+            return False
+        table = self._amazon_get_lookup_table()
+        return table['states'].get((country_id, key), False)
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super(ResCountry, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(ResCountry, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(ResCountry, self).unlink()
+
+
+class ResCountryState(models.Model):
+    _inherit = 'res.country.state'
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super(ResCountryState, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(ResCountryState, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(ResCountryState, self).unlink()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from openerp import _, api, fields, models
+from openerp.tools import ustr
+
+_logger = logging.getLogger(__name__)
+
+MAX_ERRORS_DISPLAYED = 100
+
+
+class ImportMetrics(object):
+    """ Timings and counters of an import run, kept in memory during the
+        run then saved as an amazon.import.run.
+        Phases are timed in the main thread only, the cursor gives
+        the number of queries of each phase
+    """
+
+    def __init__(self, cr=None):
+        self.cr = cr
+        self.date_start = datetime.utcnow()
+        self.start = time.time()
+        self.phases = OrderedDict()
+        self.counters = defaultdict(int)
+        self.errors = []
+        self.start_query_count = self._query_count()
+
+    def _query_count(self):
+        return getattr(self.cr, 'sql_log_count', 0)
+
+    @contextmanager
+    def phase(self, name):
+        start, queries = time.time(), self._query_count()
+        try:
+            yield
+        finally:
+            self.add_phase(
+                name, time.time() - start, self._query_count() - queries)
+
+    def add_phase(self, name, duration, queries=0):
+        phase = self.phases.setdefault(name, [0.0, 0, 0])
+        phase[0] += duration
+        phase[1] += queries
+        phase[2] += 1
+
+    def iter_phase(self, name, iterable):
+        """ Yield the items of iterable, the time spent waiting for them
+            (downloads done by threads for instance) is the phase
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def add_error(self, message):
+        """ Record an error which does not stop the run """
+        self.errors.append(message)
+        self.counters['errors'] += 1
+
+    def add_connection(self, mws):
+        """ Counters of the Amazon requests of the connection """
+        for key, value in getattr(mws, 'stats', {}).items():
+            self.counters[key] += value
+
+
+def get_metrics(cache):
+    """ Metrics of the import run of the cache,
+        unsaved ones if the run is not measured
+    """
+    metrics = (cache or {}).get('metrics')
+    return metrics if metrics is not None else ImportMetrics()
+
+
+class AmazonImportRun(models.Model):
+    _name = 'amazon.import.run'
+    _description = 'Amazon Import Run'
+    _order = 'date_start desc, id desc'
+    _rec_name = 'date_start'
+
+    backend_id = fields.Many2one(
+        comodel_name='amazon.backend', string='Backend', required=True,
+        ondelete='cascade', index=True, readonly=True)
+    attachment_id = fields.Many2one(
+        comodel_name='ir.attachment.metadata', string='Report',
+        ondelete='cascade', index=True, readonly=True)
+    run_type = fields.Selection(
+        selection=[
+            ('report', 'Report Download'),
+            ('fba', 'FBA Sales'),
+            ('sale', 'Sales Report'),
+            ('payment', 'Settlement Report'),
+            ('listing', 'Listings Report'),
+        ], string='Type', required=True, readonly=True)
+    state = fields.Selection(
+        selection=[
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+        ], required=True, readonly=True)
+    message = fields.Text(readonly=True)
+    date_start = fields.Datetime(string='Start', readonly=True)
+    duration = fields.Float(string='Duration (s)', readonly=True)
+    query_count = fields.Integer(string='Queries', readonly=True)
+    api_call_count = fields.Integer(string='API Calls', readonly=True)
+    throttled_count = fields.Integer(
+        string='Throttled Calls', readonly=True,
+        help="Requests refused by Amazon because of the quotas")
+    throttle_wait = fields.Float(
+        string='Throttle Wait (s)', readonly=True,
+        help="Time waited for the quotas of Amazon, summed on all "
+             "the download threads")
+    bytes_downloaded = fields.Integer(string='Bytes', readonly=True)
+    record_count = fields.Integer(
+        string='Documents', readonly=True,
+        help="Reports downloaded, sales created or move lines imported")
+    error_count = fields.Integer(string='Errors', readonly=True)
+    phase_ids = fields.One2many(
+        comodel_name='amazon.import.run.phase', inverse_name='run_id',
+        string='Phases', readonly=True)
+
+    @api.model
+    def _prepare_run(self, metrics, backend, run_type, attachment=None,
+                     error=None):
+        counters = metrics.counters
+        duration = time.time() - metrics.start
+        return {
+            'backend_id': backend.id,
+            'attachment_id': attachment and attachment.id or False,
+            'run_type': run_type,
+            'state': error is None and 'done' or 'failed',
+            'message': self._get_message(metrics, error=error),
+            'date_start': fields.Datetime.to_string(metrics.date_start),
+            'duration': duration,
+            'query_count': (metrics._query_count() -
+                            metrics.start_query_count),
+            'api_call_count': counters['calls'],
+            'throttled_count': counters['throttled'],
+            'throttle_wait': counters['throttle_wait'],
+            'bytes_downloaded': counters['bytes'],
+            'record_count': counters['records'],
+            'error_count': counters['errors'],
+            'phase_ids': [(0, 0, {
+                'sequence': sequence,
+                'name': name,
+                'duration': phase_duration,
+                'query_count': queries,
+                'count': count,
+                'percent': duration and 100 * phase_duration / duration,
+            }) for sequence, (name, (phase_duration, queries, count))
+                in enumerate(metrics.phases.items())],
+        }
+
+    @api.model
+    def _get_message(self, metrics, error=None):
+        if error is not None:
+            return ustr(error)
+        errors = sorted(metrics.errors)
+        if len(errors) > MAX_ERRORS_DISPLAYED:
+            errors = errors[:MAX_ERRORS_DISPLAYED] + [
+                _("... and %s more") % (len(errors) - MAX_ERRORS_DISPLAYED)]
+        return u'\n'.join(errors) or False
+
+    @api.model
+    def _save(self, metrics, backend, run_type, attachment=None,
+              error=None):
+        """ The run is saved with its own cursor: it is kept when the
+            import fails and its transaction is rollbacked
+        """
+        vals = self._prepare_run(
+            metrics, backend, run_type, attachment=attachment, error=error)
+        try:
+            with self.pool.cursor() as cr:
+                self.env(cr=cr)[self._name].sudo().create(vals)
+        except Exception:
+            _logger.exception("Amazon import run not saved")
+
+
+class AmazonImportRunPhase(models.Model):
+    _name = 'amazon.import.run.phase'
+    _description = 'Amazon Import Run Phase'
+    _order = 'run_id, sequence'
+
+    run_id = fields.Many2one(
+        comodel_name='amazon.import.run', string='Run', required=True,
+        ondelete='cascade', index=True)
+    sequence = fields.Integer()
+    name = fields.Char(required=True)
+    duration = fields.Float(string='Duration (s)')
+    percent = fields.Float(string='% of the Run', digits=(16, 1))
+    query_count = fields.Integer(string='Queries')
+    count = fields.Integer(
+        string='Calls', help="Number of times the phase was entered")
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+import calendar
+import hashlib
+import logging
+import random
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import iso8601
+except ImportError:
+    _logger.debug('Cannot `import iso8601` library.')
+
+try:
+    from boto.mws.connection import MWSConnection, api_version_path
+except ImportError:
+    _logger.debug('Cannot `import boto` library.')
+    MWSConnection = object
+
+
+# MWS throttling by operation: (burst size, seconds to restore one request)
+QUOTAS = {
+    'GetReportList': (10, 60),
+    'GetReportListByNextToken': (30, 2),
+    'GetReport': (15, 60),
+    'RequestReport': (15, 60),
+    'ListOrders': (6, 60),
+    'ListOrderItems': (30, 2),
+    'GetOrder': (6, 60),
+    'SubmitFeed': (15, 120),
+    'GetFeedSubmissionList': (10, 45),
+    'GetFeedSubmissionResult': (15, 60),
+}
+# These operations share the quota of the first request
+SHARED_QUOTAS = {
+    'ListOrdersByNextToken': 'ListOrders',
+    'ListOrderItemsByNextToken': 'ListOrderItems',
+    'GetFeedSubmissionListByNextToken': 'GetFeedSubmissionList',
+}
+THROTTLED_MAX_RETRY = 6
+THROTTLED_MAX_WAIT = 300
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class TokenBucket(object):
+    """ Requests allowed by Amazon for an operation of a seller:
+        'burst' requests at most, one more every 'restore' seconds
+    """
+
+    def __init__(self, burst, restore):
+        self.burst = burst
+        self.restore = restore
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated) / self.restore)
+        self.updated = now
+
+    def acquire(self):
+        """ Wait for a request to be allowed,
+            return the time waited in seconds
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.blocked_until and now >= self.blocked_until:
+                    # the quota was reset by Amazon
+                    self.tokens = float(self.burst)
+                    self.blocked_until = 0
+                    self.updated = now
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                if self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    wait = (1 - self.tokens) * self.restore
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, remaining, resets_on=None):
+        """ Align on the quota returned by Amazon in the headers """
+        with self.lock:
+            self._refill(time.time())
+            self.tokens = min(self.tokens, remaining)
+            if remaining < 1 and resets_on:
+                self.blocked_until = resets_on
+
+    def drain(self):
+        """ Amazon throttled us: no request until a token is restored """
+        with self.lock:
+            self.tokens = 0
+            self.updated = time.time()
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(seller, operation):
+    """ Buckets are shared by all the connections of a seller account """
+    operation = SHARED_QUOTAS.get(operation, operation)
+    if operation not in QUOTAS:
+        return None
+    with _buckets_lock:
+        key = (seller, operation)
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(*QUOTAS[operation])
+        return _buckets[key]
+
+
+def parse_quota_headers(response):
+    """ Return (remaining requests, epoch of reset) if given by Amazon """
+    remaining = response.getheader('x-mws-quota-remaining')
+    if remaining is None:
+        return None
+    resets_on = response.getheader('x-mws-quota-resetsOn')
+    if resets_on:
+        resets_on = calendar.timegm(
+            iso8601.parse_date(resets_on).utctimetuple())
+    return float(remaining), resets_on
+
+
+class AmazonMWSConnection(MWSConnection):
+    """ MWS connection waiting for the quota of each operation
+        before sending a request, and retrying throttled requests
+        with a jittered exponential backoff.
+        stats counts the requests of all the threads using the connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AmazonMWSConnection, self).__init__(*args, **kwargs)
+        self.stats = {
+            'calls': 0,
+            'throttled': 0,
+            'throttle_wait': 0.0,
+            'bytes': 0,
+        }
+        self._stats_lock = threading.Lock()
+
+    def _add_stats(self, **values):
+        with self._stats_lock:
+            for key, value in values.items():
+                self.stats[key] += value
+
+    def _call_with_quota(self, action, method, *args, **kwargs):
+        bucket = get_bucket(self.Merchant, action)
+        attempt = 0
+        while True:
+            if bucket:
+                self._add_stats(throttle_wait=bucket.acquire())
+            self._add_stats(calls=1)
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, 'error_code', None) != 'RequestThrottled' \
+                        or attempt >= THROTTLED_MAX_RETRY:
+                    raise
+                base = bucket.restore if bucket else 1
+                wait = random.uniform(
+                    0, min(THROTTLED_MAX_WAIT, base * 2 ** attempt))
+                _logger.info(
+                    "Request %s throttled, retry in %.1f seconds",
+                    action, wait)
+                if bucket:
+                    bucket.drain()
+                self._add_stats(throttled=1, throttle_wait=wait)
+                time.sleep(wait)
+                attempt += 1
+
+    def _post_request(self, request, params, parser, *args, **kwargs):
+        return self._call_with_quota(
+            params.get('Action'),
+            super(AmazonMWSConnection, self)._post_request,
+            request, params, parser, *args, **kwargs)
+
+    def get_report_to_file(self, fileobj, ReportId):
+        """ Write the report in fileobj chunk by chunk
+            instead of keeping it in memory like get_report does.
+            Return the size and the sha1 of the report
+        """
+        version, accesskey, path = api_version_path['Reports']
+        params = {
+            'Action': 'GetReport',
+            'Version': version,
+            'ReportId': ReportId,
+            accesskey: getattr(self, accesskey),
+        }
+        return self._call_with_quota(
+            'GetReport', self._download, path, params, fileobj)
+
+    def get_feed_submission_result_to_file(self, fileobj, FeedSubmissionId):
+        """ Write the processing report of a feed in fileobj, it is
+            returned as is by Amazon: XML or flat file
+        """
+        version, accesskey, path = api_version_path['Feeds']
+        params = {
+            'Action': 'GetFeedSubmissionResult',
+            'Version': version,
+            'FeedSubmissionId': FeedSubmissionId,
+            accesskey: getattr(self, accesskey),
+        }
+        return self._call_with_quota(
+            'GetFeedSubmissionResult', self._download, path, params, fileobj)
+
+    def _download(self, path, params, fileobj):
+        request = self.build_base_http_request(
+            'POST', self._sandboxify(path), None, params=params,
+            headers={}, host=self.host)
+        # the throttled requests are retried by _call_with_quota only
+        response = self._mexe(request, override_num_retries=0)
+        if response.status != 200:
+            raise self._response_error_factory(
+                response.status, response.reason, response.read())
+        fileobj.seek(0)
+        fileobj.truncate()
+        size = 0
+        md5 = hashlib.md5()
+        sha1 = hashlib.sha1()
+        for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+            fileobj.write(chunk)
+            size += len(chunk)
+            md5.update(chunk)
+            sha1.update(chunk)
+        digest = response.getheader('Content-MD5')
+        if digest is not None and \
+                base64.b64encode(md5.digest()) != digest:
+            raise IOError("Corrupted download of %s %s" % (
+                params['Action'],
+                params.get('ReportId') or params.get('FeedSubmissionId')))
+        self._add_stats(bytes=size)
+        return size, sha1.hexdigest()
+
+    def _mexe(self, request, *args, **kwargs):
+        if not args:
+            # boto would retry the throttled requests without the quotas
+            kwargs['override_num_retries'] = 0
+        response = super(AmazonMWSConnection, self)._mexe(
+            request, *args, **kwargs)
+        quota = parse_quota_headers(response)
+        if quota:
+            bucket = get_bucket(self.Merchant, request.params.get('Action'))
+            if bucket:
+                bucket.update(*quota)
+        return response
@@ -11,3 +11,7 @@ class ResPartner(models.Model):
 
     amazon_backend_id = fields.Many2one(
         comodel_name='amazon.backend', string="Amazon Backend")
+    amazon_address_hash = fields.Char(
+        string="Amazon Address Hash", index=True, copy=False, readonly=True,
+        help="Hash of the delivery address given by Amazon, used to find "
+             "back this address in the next imported sales")
@@ -5,6 +5,10 @@
 
 from openerp import _, api, fields, models
 from openerp.exceptions import Warning as UserError
+import openerp.addons.decimal_precision as dp
+
+import logging
+_logger = logging.getLogger(__name__)
 
 
 class ProductProduct(models.Model):
@@ -26,24 +30,14 @@ class ProductTemplate(models.Model):
 
     @api.multi
     def populate_amazon_binding(self):
-        # TODO make it complete lines instead of mass create ...
-        # with a wizard/action from product list ?
-        for rec in self:
-            values = []
-            if not rec.amazon_variant_bind_ids:
-                backends = self.env['amazon.backend'].search([])
-                for backend in backends:
-                    values.extend(
-                        [{'backend_id': backend.id, 'record_id': x.id}
-                         for x in rec.product_variant_ids
-                         if x.default_code])
-                if not values:
-                    raise UserError(
-                        _("No backend or Reference for this product"))
-                for vals in values:
-                    self.env['amazon.product'].create(vals)
-            else:
-                raise UserError(_("Remove all items before to populate"))
+        """ Bind the variants with a reference missing on the backends """
+        backends = self.env['amazon.backend'].search([])
+        variants = self.mapped('product_variant_ids').filtered(
+            'default_code')
+        if not backends or not variants:
+            raise UserError(_("No backend or Reference for this product"))
+        self.env['amazon.product']._populate(
+            backends, [('product_tmpl_id', 'in', self.ids)])
 
 
 class AmazonProduct(models.Model):
@@ -60,6 +54,23 @@ class AmazonProduct(models.Model):
              "(mandatory because of searching method in sales import")
     backend_id = fields.Many2one(
         comodel_name='amazon.backend', string='Backend', required=True)
+    asin = fields.Char(
+        string='ASIN', help="Amazon product id, given by the listings report")
+    last_qty_sent = fields.Integer(
+        string='Last Quantity Sent', readonly=True,
+        help="Quantity of the last stock feed, sent again when the feed "
+             "failed")
+    stock_feed_id = fields.Many2one(
+        comodel_name='amazon.feed', string='Last Stock Feed', readonly=True,
+        ondelete='set null')
+    last_price_sent = fields.Float(
+        string='Last Price Sent', readonly=True,
+        digits=dp.get_precision('Product Price'),
+        help="Price of the last price feed, sent again when the feed "
+             "failed")
+    price_feed_id = fields.Many2one(
+        comodel_name='amazon.feed', string='Last Price Feed', readonly=True,
+        ondelete='set null')
 
     _sql_constraints = [
         ('external_id_uniq', 'unique(backend_id, external_id)',
@@ -76,8 +87,9 @@ class AmazonProduct(models.Model):
 
     @api.model
     def create(self, vals):
-        product = self.env['product.product'].browse(vals.get('record_id'))
         if not vals.get('external_id'):
+            product = self.env['product.product'].browse(
+                vals.get('record_id'))
             if product.default_code:
                 vals['external_id'] = product.default_code
             else:
@@ -85,3 +97,107 @@ class AmazonProduct(models.Model):
                     _("Missing SKU or product Reference with these data %s"
                       % vals))
         return super(AmazonProduct, self).create(vals)
+
+    @api.model
+    def _populate(self, backends, domain=None, chunk_size=5000):
+        """ Create the missing bindings of the products of the domain
+            which have a reference, the reference is the SKU.
+            Missing couples (backend, product) are computed by one query
+            then inserted by chunks, without the ORM: it may be run
+            again to complete the bindings of a big catalog.
+            Return the number of bindings created
+        """
+        if not backends:
+            return 0
+        # the bindings are inserted without the ORM
+        self.check_access_rights('create')
+        product_m = self.env['product.product']
+        query = product_m._where_calc(domain or [])
+        product_m._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        # a SKU already bound on a backend can not be bound again
+        self._cr.execute("""
+            SELECT DISTINCT ON (backend.id, product.default_code)
+                backend.id, product.id, product.default_code
+            FROM amazon_backend AS backend
+            CROSS JOIN product_product AS product
+            WHERE backend.id IN %%s
+                AND product.id IN (
+                    SELECT product_product.id FROM %s WHERE %s)
+                AND product.default_code IS NOT NULL
+                AND product.default_code != ''
+                AND NOT EXISTS (
+                    SELECT 1 FROM amazon_product AS binding
+                    WHERE binding.backend_id = backend.id
+                        AND (binding.record_id = product.id
+                             OR binding.external_id = product.default_code))
+            ORDER BY backend.id, product.default_code, product.id
+            """ % (from_clause, where_clause or 'TRUE'),
+            [tuple(backends.ids)] + where_params)
+        rows = [row + (None,) for row in self._cr.fetchall()]
+        self._insert_bindings(rows, chunk_size=chunk_size)
+        return len(rows)
+
+    @api.model
+    def _insert_bindings(self, rows, chunk_size=5000):
+        """ Insert the bindings without the ORM
+            rows: (backend id, product id, sku, asin)
+        """
+        for index in range(0, len(rows), chunk_size):
+            chunk = rows[index:index + chunk_size]
+            values = ', '.join(["(%s, %s, %s, %s, %s, "
+                                "now() at time zone 'UTC', %s, "
+                                "now() at time zone 'UTC')"] * len(chunk))
+            query = """
+                INSERT INTO amazon_product (
+                    backend_id, record_id, external_id, asin,
+                    create_uid, create_date, write_uid, write_date)
+                VALUES %s
+                """ % values
+            params = [value for row in chunk
+                      for value in row + (self._uid, self._uid)]
+            self._cr.execute(query, params)
+            _logger.info("%s Amazon bindings created", index + len(chunk))
+        self.invalidate_cache()
+
+    @api.model
+    def _update_asins(self, rows, chunk_size=5000):
+        """ rows: (binding id, asin) """
+        self._bulk_write(['asin'], rows, chunk_size=chunk_size)
+
+    @api.model
+    def _bulk_write(self, fnames, rows, chunk_size=5000):
+        """ Write a different value on each binding without the ORM
+            rows: (binding id, value of each field of fnames)
+        """
+        placeholder = '(%s)' % ', '.join(['%s'] * (len(fnames) + 1))
+        for index in range(0, len(rows), chunk_size):
+            chunk = rows[index:index + chunk_size]
+            self._cr.execute("""
+                UPDATE amazon_product SET %s,
+                    write_uid = %%s, write_date = now() at time zone 'UTC'
+                FROM (VALUES %s) AS data (id, %s)
+                WHERE amazon_product.id = data.id
+                """ % (', '.join('%s = data.%s' % (fname, fname)
+                                 for fname in fnames),
+                       ', '.join([placeholder] * len(chunk)),
+                       ', '.join(fnames)),
+                [self._uid] + [value for row in chunk for value in row])
+        self.invalidate_cache()
+
+    @api.model
+    def _reset_sent(self, fname, feed_fname, feed, skus=None):
+        """ Empty fname on the bindings sent by feed, or only the ones
+            of skus: the next feed sends them again
+        """
+        if skus is not None and not skus:
+            return
+        query = """
+            UPDATE amazon_product SET %s = NULL
+            WHERE %s = %%s""" % (fname, feed_fname)
+        params = [feed.id]
+        if skus is not None:
+            query += " AND external_id IN %s"
+            params.append(tuple(skus))
+        self._cr.execute(query, params)
+        self.invalidate_cache()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+from openerp import api, fields, models
+from openerp.tools import ustr
+
+from openerp.addons.connector.queue.job import job
+from openerp.addons.connector.session import ConnectorSession
+
+_logger = logging.getLogger(__name__)
+
+
+class AmazonReportChunk(models.Model):
+    _name = 'amazon.report.chunk'
+    _description = 'Amazon Report Chunk'
+    _order = 'attachment_id, sequence'
+
+    attachment_id = fields.Many2one(
+        comodel_name='ir.attachment.metadata', string='Report',
+        required=True, ondelete='cascade', index=True)
+    sequence = fields.Integer()
+    offset_start = fields.Integer(
+        help="Position in the file of the first line of the chunk")
+    offset_stop = fields.Integer(
+        help="Position in the file after the last line of the chunk")
+    order_count = fields.Integer(string='Orders')
+    state = fields.Selection(
+        selection=[
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+        ], default='pending', required=True, readonly=True)
+    message = fields.Text(readonly=True)
+
+    @api.multi
+    def _enqueue(self):
+        session = ConnectorSession(
+            self.env.cr, self.env.uid, context=self.env.context)
+        for chunk in self:
+            import_report_chunk.delay(
+                session, self._name, chunk.id,
+                description="Import chunk %s of Amazon report %s" % (
+                    chunk.sequence, chunk.attachment_id.name))
+
+    @api.multi
+    def _run(self):
+        """ Import the sales of the chunk, the failed ones are
+            reported on the chunk
+        """
+        self.ensure_one()
+        attachment = self.attachment_id
+        backend = attachment.amazon_backend_id
+        report = attachment._open_report()
+        try:
+            report.seek(self.offset_start)
+            with backend._import_run('sale', attachment=attachment) \
+                    as metrics:
+                errors = self.env['amazon.sale.importer']._import_lines(
+                    self._iter_lines(report), attachment, lock=True,
+                    metrics=metrics)
+        except Exception as e:
+            self._cr.rollback()
+            self.write({'state': 'failed', 'message': ustr(e)})
+            attachment._update_chunk_state()
+            self._cr.commit()
+            raise
+        finally:
+            report.close()
+        self.write({
+            'state': errors and 'failed' or 'done',
+            'message': u'\n'.join(errors) or False,
+        })
+        attachment._update_chunk_state()
+        return u'%s orders processed, %s failed' % (
+            self.order_count - len(errors), len(errors))
+
+    @api.multi
+    def _iter_lines(self, report):
+        position = self.offset_start
+        while position < self.offset_stop:
+            line = report.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+@job
+def import_report_chunk(session, model_name, chunk_id):
+    chunk = session.env[model_name].browse(chunk_id)
+    if not chunk.exists():
+        _logger.info("Amazon report chunk %s was deleted", chunk_id)
+        return
+    return chunk._run()
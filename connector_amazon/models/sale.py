@@ -14,12 +14,15 @@ class SaleOrder(models.Model):
         'amazon.backend',
         'Amazon Backend')
     is_amazon_fba = fields.Boolean()
+    amazon_order_id = fields.Char(
+        string='Amazon Order Id', index=True, copy=False, readonly=True)
 
     @api.model
     def _prepare_invoice(self, order, lines):
         res = super(SaleOrder, self)._prepare_invoice(order, lines)
         if order.amazon_backend_id:
             backend = order.amazon_backend_id
+            res['amazon_order_id'] = order.amazon_order_id
             if order.is_amazon_fba:
                 if backend.fba_sale_journal_id:
                     res['journal_id'] = backend.fba_sale_journal_id.id
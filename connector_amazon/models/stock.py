@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Akretion (http://www.akretion.com).
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp import fields, models
+
+
+class StockPicking(models.Model):
+    _inherit = 'stock.picking'
+
+    amazon_feed_id = fields.Many2one(
+        comodel_name='amazon.feed', string='Amazon Shipment Feed',
+        readonly=True, copy=False, index=True, ondelete='set null',
+        help="Feed which confirmed the shipment to Amazon")
+
+
+class DeliveryCarrier(models.Model):
+    _inherit = 'delivery.carrier'
+
+    amazon_carrier_code = fields.Char(
+        string='Amazon Carrier Code',
+        help="Carrier code of Amazon (UPS, DHL, Colissimo...), the name of "
+             "the carrier is sent when empty")
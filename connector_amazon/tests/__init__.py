@@ -1 +1,8 @@
 from . import test_sale
+from . import test_country
+from . import test_mws_connection
+from . import test_payment
+from . import test_benchmark
+from . import test_product
+from . import test_feed
+from . import test_checkpoint
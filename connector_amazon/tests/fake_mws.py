@@ -0,0 +1,542 @@
+# coding: utf-8
+# © 2017 Akretion
+""" Local stand-in of the Amazon MWS api, to load test the imports
+    without Amazon: run
+
+        python fake_mws.py --port 8765 --orders 5000 --latency 0.2
+
+    and call the imports with the port in the amazon_mws_port key of
+    the context, e.g. backend.with_context(amazon_mws_port=8765)
+
+    Served operations: GetReportList(ByNextToken), GetReport,
+    ListOrders(ByNextToken) and ListOrderItems with generated data,
+    SubmitFeed, GetFeedSubmissionList and GetFeedSubmissionResult:
+    the feeds are processed at once, the records of feed_errors are
+    rejected.
+    Requests are throttled like Amazon does (503 RequestThrottled)
+    with the quota of each operation, returned in the x-mws-quota
+    headers. Signatures are not checked.
+"""
+
+import argparse
+import base64
+import hashlib
+import random
+import re
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+try:
+    from .report_generator import (
+        generate_sale_report, generate_settlement_report, get_skus)
+except (ImportError, ValueError):  # run as a script
+    from report_generator import (
+        generate_sale_report, generate_settlement_report, get_skus)
+
+# (burst size, seconds to restore one request) of the operations
+QUOTAS = {
+    'GetReportList': (10, 60),
+    'GetReportListByNextToken': (30, 2),
+    'GetReport': (15, 60),
+    'ListOrders': (6, 60),
+    'ListOrderItems': (30, 2),
+    'SubmitFeed': (15, 120),
+    'GetFeedSubmissionList': (10, 45),
+    'GetFeedSubmissionResult': (15, 60),
+}
+SHARED_QUOTAS = {
+    'ListOrdersByNextToken': 'ListOrders',
+    'ListOrderItemsByNextToken': 'ListOrderItems',
+}
+REPORT_NS = 'http://mws.amazonaws.com/doc/2009-01-01/'
+ORDER_NS = 'https://mws.amazonservices.com/Orders/2013-09-01'
+REPORT_TYPES = [
+    '_GET_FLAT_FILE_ORDERS_DATA_',
+    '_GET_V2_SETTLEMENT_REPORT_DATA_FLAT_FILE_V2_',
+]
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S+00:00'
+REPORT_PAGE_SIZE = 100
+ORDER_PAGE_SIZE = 100
+# FBA orders ids must not collide with the ones of the reports
+FBA_ORDER_START = 5000000
+FEED_MESSAGE = re.compile(
+    r'<MessageID>(\d+)</MessageID>.*?<SKU>(.*?)</SKU>')
+PROCESSING_REPORT = """<?xml version="1.0" encoding="UTF-8"?>
+<AmazonEnvelope>
+<Header><DocumentVersion>1.02</DocumentVersion></Header>
+<MessageType>ProcessingReport</MessageType>
+<Message>
+<MessageID>1</MessageID>
+<ProcessingReport>
+<StatusCode>Complete</StatusCode>
+<ProcessingSummary>
+<MessagesProcessed>%s</MessagesProcessed>
+<MessagesSuccessful>%s</MessagesSuccessful>
+<MessagesWithError>%s</MessagesWithError>
+</ProcessingSummary>
+%s</ProcessingReport>
+</Message>
+</AmazonEnvelope>
+"""
+FLAT_ERROR_HEADER = \
+    'original-record-number\torder-id\terror-code\terror-type\terror-message'
+
+
+class Quota(object):
+    """ Amazon token bucket of an operation for a seller """
+
+    def __init__(self, burst, restore):
+        self.burst = burst
+        self.restore = restore
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """ Return True if the request is allowed, and the quota
+            headers to send with the response
+        """
+        with self.lock:
+            now = time.time()
+            if self.restore:
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated) / self.restore)
+            else:
+                self.tokens = self.burst
+            self.updated = now
+            allowed = self.tokens >= 1
+            if allowed:
+                self.tokens -= 1
+            resets_on = datetime.utcfromtimestamp(
+                now + (1 - self.tokens % 1) * self.restore)
+            headers = {
+                'x-mws-quota-max': str(self.burst),
+                'x-mws-quota-remaining': str(int(self.tokens)),
+                'x-mws-quota-resetsOn': resets_on.strftime(
+                    '%Y-%m-%dT%H:%M:%S.000Z'),
+            }
+            return allowed, headers
+
+
+class FakeMWS(object):
+    """ Data and quotas served by the handler """
+
+    def __init__(self, reports=10, report_orders=100, orders=500,
+                 items=2, sku_count=100, latency=0.0, jitter=0.0,
+                 quota_scale=1.0, throttle_rate=0.0, seed=0,
+                 feed_errors=None):
+        self.report_count = reports
+        self.report_orders = report_orders
+        self.order_count = orders
+        self.items = items
+        self.skus = get_skus(sku_count)
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_scale = quota_scale
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.start = datetime.utcnow().replace(microsecond=0) - \
+            timedelta(days=1)
+        self.quotas = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+        # submission id: (feed type, content)
+        self.feeds = {}
+        self.feed_errors = set(feed_errors or [])
+
+    def get_quota(self, seller, action):
+        action = SHARED_QUOTAS.get(action, action)
+        burst, restore = QUOTAS.get(action, (100, 1))
+        with self.lock:
+            key = (seller, action)
+            if key not in self.quotas:
+                self.quotas[key] = Quota(burst, restore * self.quota_scale)
+            return self.quotas[key]
+
+    def count(self, action, status):
+        with self.lock:
+            key = '%s %s' % (action, status)
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def wait(self):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def is_throttled(self):
+        return self.throttle_rate and \
+            self.random.random() < self.throttle_rate
+
+    def report_id(self, index):
+        return '%011d' % (index + 1)
+
+    def report_body(self, report_id):
+        index = int(report_id) - 1
+        if not 0 <= index < self.report_count:
+            return None
+        report = StringIO()
+        kwargs = {
+            'orders': self.report_orders,
+            'sku_count': len(self.skus),
+            'seed': self.seed + index,
+            'start': index * self.report_orders,
+        }
+        if REPORT_TYPES[index % len(REPORT_TYPES)] == REPORT_TYPES[0]:
+            generate_sale_report(report, **kwargs)
+        else:
+            generate_settlement_report(report, **kwargs)
+        return report.getvalue()
+
+    def order_id(self, index):
+        index += FBA_ORDER_START
+        return '40%s-%07d-%07d' % (index % 8, index, index * 7 % 10000000)
+
+    def submit_feed(self, feed_type, content):
+        with self.lock:
+            feed_id = '%011d' % (len(self.feeds) + 1)
+            self.feeds[feed_id] = (feed_type, content)
+        return feed_id
+
+    def feed_result(self, feed_id):
+        """ Processing report of a feed, XML or flat file like the feed,
+            the SKUs or order ids of feed_errors are rejected
+        """
+        if feed_id not in self.feeds:
+            return None
+        feed_type, content = self.feeds[feed_id]
+        if content.lstrip().startswith('<?xml'):
+            messages = FEED_MESSAGE.findall(content)
+            errors = [(message_id, sku) for message_id, sku in messages
+                      if sku in self.feed_errors]
+            results = ''.join(
+                '<Result><MessageID>%s</MessageID>'
+                '<ResultCode>Error</ResultCode>'
+                '<ResultMessageCode>8560</ResultMessageCode>'
+                '<ResultDescription>Rejected by the stand-in'
+                '</ResultDescription>'
+                '<AdditionalInfo><SKU>%s</SKU></AdditionalInfo>'
+                '</Result>\n' % error for error in errors)
+            return PROCESSING_REPORT % (
+                len(messages), len(messages) - len(errors), len(errors),
+                results)
+        rows = [line.split('\t') for line in content.splitlines()[1:]]
+        errors = [(index, row[0]) for index, row in enumerate(rows, 1)
+                  if row[0] in self.feed_errors]
+        lines = [
+            'Feed Processing Summary:',
+            '\tNumber of records processed\t\t%s' % len(rows),
+            '\tNumber of records successful\t\t%s'
+            % (len(rows) - len(errors)),
+            '',
+            FLAT_ERROR_HEADER,
+        ] + ['%s\t%s\t18028\tError\tRejected by the stand-in' % error
+             for error in errors]
+        return '\n'.join(lines) + '\n'
+
+
+def _element(name, value):
+    return '<%s>%s</%s>' % (name, escape(unicode(value)), name)
+
+
+def _money(name, amount):
+    return '<%s><CurrencyCode>EUR</CurrencyCode><Amount>%.2f</Amount>' \
+           '</%s>' % (name, amount, name)
+
+
+def _token(offset):
+    return base64.b64encode('offset:%s' % offset)
+
+
+def _offset(token):
+    try:
+        return int(base64.b64decode(token).split(':')[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class FakeMWSHandler(BaseHTTPRequestHandler):
+    """ One request of the MWS api, self.server.mws holds the data """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader('content-length') or 0)
+        body = length and self.rfile.read(length) or ''
+        if 'x-www-form-urlencoded' in (
+                self.headers.getheader('content-type') or ''):
+            params.update(urlparse.parse_qsl(body))
+        mws = self.server.mws
+        action = params.get('Action', '')
+        mws.wait()
+        seller = params.get('SellerId') or params.get('Merchant')
+        allowed, headers = mws.get_quota(seller, action).consume()
+        if not allowed or mws.is_throttled():
+            mws.count(action, 503)
+            return self.send_error_response(
+                503, 'RequestThrottled', 'Request is throttled', headers)
+        method = getattr(self, 'action_%s' % action, None)
+        if not method:
+            mws.count(action, 400)
+            return self.send_error_response(
+                400, 'InvalidParameterValue',
+                'Unsupported action %s' % action, headers)
+        mws.count(action, 200)
+        self.body = body
+        method(params, headers)
+
+    def send_body(self, status, body, headers, content_type='text/xml'):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_xml(self, action, namespace, result, headers):
+        body = (
+            '<?xml version="1.0"?>'
+            '<%(action)sResponse xmlns="%(ns)s">'
+            '<%(action)sResult>%(result)s</%(action)sResult>'
+            '<ResponseMetadata><RequestId>%(request)s</RequestId>'
+            '</ResponseMetadata></%(action)sResponse>') % {
+                'action': action,
+                'ns': namespace,
+                'result': result,
+                'request': self.request_id(),
+        }
+        self.send_body(200, body.encode('utf-8'), headers)
+
+    def send_error_response(self, status, code, message, headers):
+        body = (
+            '<?xml version="1.0"?>'
+            '<ErrorResponse xmlns="%s"><Error><Type>Sender</Type>'
+            '<Code>%s</Code><Message>%s</Message></Error>'
+            '<RequestID>%s</RequestID></ErrorResponse>') % (
+                REPORT_NS, code, escape(message), self.request_id())
+        self.send_body(status, body, headers)
+
+    def request_id(self):
+        return '%032x' % random.getrandbits(128)
+
+    def _report_list(self, offset, headers, action='GetReportList'):
+        mws = self.server.mws
+        stop = min(offset + REPORT_PAGE_SIZE, mws.report_count)
+        result = []
+        for index in range(offset, stop):
+            available = mws.start + timedelta(minutes=index)
+            result.append(
+                '<ReportInfo>%s%s%s%s%s</ReportInfo>' % (
+                    _element('ReportId', mws.report_id(index)),
+                    _element('ReportType',
+                             REPORT_TYPES[index % len(REPORT_TYPES)]),
+                    _element('ReportRequestId', index + 1),
+                    _element('AvailableDate',
+                             available.strftime(DATE_FORMAT)),
+                    _element('Acknowledged', 'false')))
+        if stop < mws.report_count:
+            result.insert(0, _element('NextToken', _token(stop)) +
+                          _element('HasNext', 'true'))
+        else:
+            result.insert(0, _element('HasNext', 'false'))
+        self.send_xml(action, REPORT_NS, ''.join(result), headers)
+
+    def action_GetReportList(self, params, headers):
+        self._report_list(0, headers)
+
+    def action_GetReportListByNextToken(self, params, headers):
+        offset = _offset(params.get('NextToken', ''))
+        if offset is None:
+            return self.send_error_response(
+                400, 'InvalidParameterValue', 'Invalid NextToken', headers)
+        self._report_list(offset, headers, 'GetReportListByNextToken')
+
+    def action_GetReport(self, params, headers):
+        body = self.server.mws.report_body(params.get('ReportId', ''))
+        if body is None:
+            return self.send_error_response(
+                400, 'InvalidParameterValue', 'Unknown ReportId', headers)
+        headers = dict(headers, **{
+            'Content-MD5': base64.b64encode(hashlib.md5(body).digest())})
+        self.send_body(200, body, headers, content_type='text/plain')
+
+    def _order_list(self, offset, headers, action='ListOrders'):
+        mws = self.server.mws
+        stop = min(offset + ORDER_PAGE_SIZE, mws.order_count)
+        result = []
+        if stop < mws.order_count:
+            result.append(_element('NextToken', _token(stop)))
+        result.append(_element(
+            'LastUpdatedBefore', datetime.utcnow().strftime(DATE_FORMAT)))
+        result.append('<Orders>')
+        for index in range(offset, stop):
+            date = (mws.start + timedelta(seconds=index)).strftime(
+                DATE_FORMAT)
+            result.append(
+                '<Order>%s%s%s%s%s%s%s'
+                '<ShippingAddress>%s%s%s%s%s</ShippingAddress>%s%s'
+                '</Order>' % (
+                    _element('AmazonOrderId', mws.order_id(index)),
+                    _element('PurchaseDate', date),
+                    _element('LastUpdateDate', date),
+                    _element('OrderStatus', 'Shipped'),
+                    _element('FulfillmentChannel', 'AFN'),
+                    _element('SalesChannel', 'Amazon.fr'),
+                    _element('MarketplaceId', 'A13V1IB3VIYZZH'),
+                    _element('Name', 'FBA Buyer %s' % index),
+                    _element('AddressLine1', '%s rue du test' % index),
+                    _element('City', 'Lyon'),
+                    _element('PostalCode', '69001'),
+                    _element('CountryCode', 'FR'),
+                    _money('OrderTotal', 10.0 * mws.items),
+                    _element('BuyerEmail',
+                             'fba%s@marketplace.amazon.fr' % index)))
+        result.append('</Orders>')
+        self.send_xml(action, ORDER_NS, ''.join(result), headers)
+
+    def action_ListOrders(self, params, headers):
+        self._order_list(0, headers)
+
+    def action_ListOrdersByNextToken(self, params, headers):
+        offset = _offset(params.get('NextToken', ''))
+        if offset is None:
+            return self.send_error_response(
+                400, 'InvalidParameterValue', 'Invalid NextToken', headers)
+        self._order_list(offset, headers, 'ListOrdersByNextToken')
+
+    def action_ListOrderItems(self, params, headers):
+        mws = self.server.mws
+        order_id = params.get('AmazonOrderId', '')
+        rand = random.Random(order_id)
+        result = [_element('AmazonOrderId', order_id), '<OrderItems>']
+        for index in range(mws.items):
+            result.append(
+                '<OrderItem>%s%s%s%s%s%s%s</OrderItem>' % (
+                    _element('SellerSKU', rand.choice(mws.skus)),
+                    _element('OrderItemId', '%s%02d' % (
+                        order_id.replace('-', ''), index)),
+                    _element('Title', 'Benchmark product'),
+                    _element('QuantityOrdered', 1),
+                    _element('QuantityShipped', 1),
+                    _money('ItemPrice', 10.0),
+                    _money('ShippingPrice', 0.0)))
+        result.append('</OrderItems>')
+        self.send_xml('ListOrderItems', ORDER_NS, ''.join(result), headers)
+
+    def _feed_info(self, feed_id, status):
+        feed_type = self.server.mws.feeds[feed_id][0]
+        return '<FeedSubmissionInfo>%s%s%s%s</FeedSubmissionInfo>' % (
+            _element('FeedSubmissionId', feed_id),
+            _element('FeedType', feed_type),
+            _element('SubmittedDate',
+                     datetime.utcnow().strftime(DATE_FORMAT)),
+            _element('FeedProcessingStatus', status))
+
+    def action_SubmitFeed(self, params, headers):
+        feed_id = self.server.mws.submit_feed(
+            params.get('FeedType', ''), self.body)
+        self.send_xml('SubmitFeed', REPORT_NS,
+                      self._feed_info(feed_id, '_SUBMITTED_'), headers)
+
+    def action_GetFeedSubmissionList(self, params, headers):
+        feed_ids = [value for key, value in sorted(params.items())
+                    if key.startswith('FeedSubmissionIdList.Id.')]
+        result = [_element('HasNext', 'false')] + [
+            self._feed_info(feed_id, '_DONE_') for feed_id in feed_ids
+            if feed_id in self.server.mws.feeds]
+        self.send_xml('GetFeedSubmissionList', REPORT_NS, ''.join(result),
+                      headers)
+
+    def action_GetFeedSubmissionResult(self, params, headers):
+        body = self.server.mws.feed_result(
+            params.get('FeedSubmissionId', ''))
+        if body is None:
+            return self.send_error_response(
+                400, 'InvalidParameterValue', 'Unknown FeedSubmissionId',
+                headers)
+        headers = dict(headers, **{
+            'Content-MD5': base64.b64encode(hashlib.md5(body).digest())})
+        self.send_body(200, body, headers, content_type='text/plain')
+
+
+class FakeMWSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, mws, verbose=False):
+        HTTPServer.__init__(self, address, FakeMWSHandler)
+        self.mws = mws
+        self.verbose = verbose
+
+
+def start_server(mws, host='localhost', port=0):
+    """ Serve in a thread, return the server: its port is
+        server.server_address[1], stop it with server.shutdown()
+    """
+    server = FakeMWSServer((host, port), mws)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--reports', type=int, default=10,
+                        help="Number of available reports")
+    parser.add_argument('--report-orders', type=int, default=100,
+                        help="Orders by report")
+    parser.add_argument('--orders', type=int, default=500,
+                        help="FBA orders returned by ListOrders")
+    parser.add_argument('--items', type=int, default=2,
+                        help="Items by FBA order")
+    parser.add_argument('--skus', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds before each response")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="Random seconds added to the latency")
+    parser.add_argument('--quota-scale', type=float, default=1.0,
+                        help="Factor of the restore rates, 0 disables "
+                             "the quotas")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Ratio of requests throttled anyway, "
+                             "to reproduce throttling storms")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    mws = FakeMWS(
+        reports=args.reports, report_orders=args.report_orders,
+        orders=args.orders, items=args.items, sku_count=args.skus,
+        latency=args.latency, jitter=args.jitter,
+        quota_scale=args.quota_scale, throttle_rate=args.throttle_rate,
+        seed=args.seed)
+    server = FakeMWSServer((args.host, args.port), mws, args.verbose)
+    print "Fake MWS listening on %s:%s" % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for key, count in sorted(mws.stats.items()):
+        print "%s: %s" % (key, count)
+
+
+if __name__ == '__main__':
+    main()
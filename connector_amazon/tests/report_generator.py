@@ -0,0 +1,145 @@
+# coding: utf-8
+# © 2017 Akretion
+""" Synthetic Amazon reports, to benchmark the importers on
+    files of any size
+"""
+
+import random
+from datetime import datetime, timedelta
+
+SALE_HEADER = [
+    'order-id', 'order-item-id', 'purchase-date', 'payments-date',
+    'buyer-email', 'buyer-name', 'buyer-phone-number', 'sku',
+    'product-name', 'quantity-purchased', 'currency', 'item-price',
+    'item-tax', 'shipping-price', 'shipping-tax', 'ship-service-level',
+    'recipient-name', 'ship-address-1', 'ship-address-2', 'ship-address-3',
+    'ship-city', 'ship-state', 'ship-postal-code', 'ship-country',
+    'ship-phone-number', 'delivery-start-date', 'delivery-end-date',
+    'delivery-time-zone', 'delivery-Instructions', 'sales-channel',
+]
+SETTLEMENT_HEADER = [
+    'settlement-id', 'settlement-start-date', 'settlement-end-date',
+    'deposit-date', 'total-amount', 'currency', 'transaction-type',
+    'order-id', 'merchant-order-id', 'adjustment-id', 'shipment-id',
+    'marketplace-name', 'amount-type', 'amount-description', 'amount',
+    'fulfillment-id', 'posted-date', 'posted-date-time', 'order-item-code',
+    'merchant-order-item-id', 'merchant-adjustment-item-id', 'sku',
+    'quantity-purchased', 'promotion-id',
+]
+CITIES = [
+    ('Lyon', '69001'), ('Marseille', '13007'), ('Paris', '75011'),
+    ('Lille', '59000'), ('Nantes', '44000'), ('Bordeaux', '33000'),
+]
+
+
+def get_skus(sku_count):
+    return ['BENCH-%05d' % index for index in range(sku_count)]
+
+
+def _order_ids(orders, start=0):
+    for index in range(start, start + orders):
+        yield '40%s-%07d-%07d' % (index % 8, index, index * 7 % 10000000)
+
+
+def _write(fileobj, values):
+    fileobj.write('\t'.join(values) + '\n')
+
+
+def generate_sale_report(fileobj, orders=1000, lines_per_order=1,
+                         repeat_buyer_ratio=0.2, sku_count=100, seed=0,
+                         start=0):
+    """ Write a _GET_FLAT_FILE_ORDERS_DATA_ report in fileobj,
+        return the number of lines written (without the header)
+        start: index of the first order, to get other order ids
+    """
+    rand = random.Random(seed)
+    skus = get_skus(sku_count)
+    buyers = []
+    date = datetime.utcnow().replace(microsecond=0) - timedelta(days=1)
+    _write(fileobj, SALE_HEADER)
+    count = 0
+    for index, order_id in enumerate(_order_ids(orders, start=start),
+                                     start):
+        if buyers and rand.random() < repeat_buyer_ratio:
+            buyer = rand.choice(buyers)
+        else:
+            city, zip_code = rand.choice(CITIES)
+            buyer = {
+                'email': 'bench%s@marketplace.amazon.fr' % index,
+                'name': 'Buyer %s' % index,
+                'street': '%s rue du test' % rand.randint(1, 200),
+                'city': city,
+                'zip': zip_code,
+            }
+            buyers.append(buyer)
+        purchase_date = (date + timedelta(seconds=index)).strftime(
+            '%Y-%m-%dT%H:%M:%S+00:00')
+        for line in range(lines_per_order):
+            count += 1
+            _write(fileobj, [
+                order_id, '%014d' % count, purchase_date, purchase_date,
+                buyer['email'], buyer['name'], '', rand.choice(skus),
+                'Benchmark product', str(rand.randint(1, 3)), 'EUR',
+                '%.2f' % rand.uniform(5, 200), '0.00',
+                line and '0.00' or '4.90', '0.00', 'Standard',
+                buyer['name'], buyer['street'], '', '', buyer['city'], '',
+                buyer['zip'], 'FR', '', '', '', '', '', 'Amazon.fr',
+            ])
+    return count
+
+
+def generate_settlement_report(fileobj, orders=1000, lines_per_order=1,
+                               refund_ratio=0.05, sku_count=100, seed=0,
+                               start=0):
+    """ Write a settlement v2 flat file report in fileobj,
+        return the number of lines written (without the header)
+    """
+    rand = random.Random(seed)
+    skus = get_skus(sku_count)
+    end = datetime.utcnow().replace(microsecond=0)
+    start_date = end - timedelta(days=14)
+    rows = []
+
+    def add(ttype, order_id, amount_type, description, amount):
+        row = dict.fromkeys(SETTLEMENT_HEADER, '')
+        row.update({
+            'settlement-id': '1234567',
+            'transaction-type': ttype,
+            'order-id': order_id,
+            'marketplace-name': 'Amazon.fr',
+            'amount-type': amount_type,
+            'amount-description': description,
+            'amount': ('%.2f' % amount).replace('.', ','),
+            'sku': rand.choice(skus),
+        })
+        rows.append(row)
+        return amount
+
+    total = 0.0
+    for order_id in _order_ids(orders, start=start):
+        for line in range(lines_per_order):
+            price = rand.uniform(5, 200)
+            total += add('Order', order_id, 'ItemPrice', 'Principal', price)
+            total += add('Order', order_id, 'ItemFees', 'Commission',
+                         -price * 0.15)
+        total += add('Order', order_id, 'ItemPrice', 'Shipping', 4.9)
+        if rand.random() < refund_ratio:
+            total += add('Refund', order_id, 'ItemPrice', 'Principal',
+                         -price)
+    total += add('other-transaction', '', 'other-transaction',
+                 'Storage Fee', -rand.uniform(10, 100))
+    _write(fileobj, SETTLEMENT_HEADER)
+    summary = dict.fromkeys(SETTLEMENT_HEADER, '')
+    summary.update({
+        'settlement-id': '1234567',
+        'settlement-start-date': start_date.strftime(
+            '%d.%m.%Y %H:%M:%S UTC'),
+        'settlement-end-date': end.strftime('%d.%m.%Y %H:%M:%S UTC'),
+        'deposit-date': end.strftime('%d.%m.%Y %H:%M:%S UTC'),
+        'total-amount': ('%.2f' % total).replace('.', ','),
+        'currency': 'EUR',
+    })
+    _write(fileobj, [summary[name] for name in SETTLEMENT_HEADER])
+    for row in rows:
+        _write(fileobj, [row[name] for name in SETTLEMENT_HEADER])
+    return len(rows) + 1
@@ -0,0 +1,179 @@
+# coding: utf-8
+# © 2017 Akretion
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from StringIO import StringIO
+
+import unittest2
+
+from openerp.tests.common import TransactionCase
+from openerp import api
+
+from ..models.amazon_payment_importer import AmazonFlatV2Parser
+from .report_generator import (
+    generate_sale_report, generate_settlement_report, get_skus)
+
+_logger = logging.getLogger(__name__)
+
+# e.g. AMAZON_BENCHMARK="orders=5000,lines_per_order=2,sku_count=500"
+BENCHMARK = os.environ.get('AMAZON_BENCHMARK')
+# file where a JSON line is appended by measure, to compare the runs
+BENCHMARK_OUTPUT = os.environ.get(
+    'AMAZON_BENCHMARK_OUTPUT', 'amazon_benchmark.jsonl')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def get_rss():
+    """ Resident size of the process in bytes """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+class MemorySampler(object):
+    """ Peak resident size reached while the sampler runs,
+        compared to the one when it started
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = self.peak = get_rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, get_rss())
+
+    def stop(self):
+        """ Return the increase of the peak resident size in bytes """
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, get_rss())
+        return self.peak - self.start
+
+
+def get_benchmark_options():
+    options = {
+        'orders': 1000,
+        'lines_per_order': 1,
+        'repeat_buyer_ratio': 0.2,
+        'sku_count': 100,
+    }
+    for option in (BENCHMARK or '').split(','):
+        if '=' in option:
+            key, value = option.split('=', 1)
+            options[key.strip()] = float(value) if '.' in value \
+                else int(value)
+    return options
+
+
+@unittest2.skipUnless(BENCHMARK, "Set AMAZON_BENCHMARK to run it")
+class AmazonBenchmark(TransactionCase):
+    """ Throughput of the importers on synthetic reports: wall time
+        and queries per 1000 orders, and the memory used by the run (the
+        increase of the peak resident size). They are logged and appended
+        to AMAZON_BENCHMARK_OUTPUT
+    """
+
+    def setUp(self):
+        super(AmazonBenchmark, self).setUp()
+        # the sale import commits, see test_sale
+        self.registry.enter_test_mode()
+        self.env = api.Environment(
+            self.registry.test_cr, self.env.uid, self.env.context)
+        self.options = get_benchmark_options()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+        self.backend.sale_import_jobs = False
+        skus = get_skus(self.options['sku_count'])
+        existing = self.backend._get_products_from_sku(skus)
+        for sku in skus:
+            if sku not in existing:
+                self.env['amazon.product'].create({
+                    'name': sku,
+                    'external_id': sku,
+                    'backend_id': self.backend.id,
+                })
+
+    @contextmanager
+    def measure(self, name, orders):
+        cr = self.env.cr
+        queries = cr.sql_log_count
+        memory = MemorySampler()
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            peak = memory.stop() / 1024. / 1024.
+        queries = cr.sql_log_count - queries
+        per_k = 1000.0 / max(orders, 1)
+        result = {
+            'date': datetime.utcnow().isoformat(),
+            'name': name,
+            'orders': orders,
+            'options': self.options,
+            'seconds_per_1k': round(duration * per_k, 3),
+            'queries_per_1k': int(queries * per_k),
+            'peak_memory_mb': round(peak, 1),
+        }
+        _logger.info(
+            "Benchmark %s, %s orders %s: %.2fs and %d queries "
+            "per 1k orders, peak memory +%.1f MB",
+            name, orders, self.options, duration * per_k, queries * per_k,
+            peak)
+        with open(BENCHMARK_OUTPUT, 'a') as output:
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+
+    def test_sale_importer(self):
+        report = StringIO()
+        options = self.options
+        generate_sale_report(
+            report, orders=options['orders'],
+            lines_per_order=options['lines_per_order'],
+            repeat_buyer_ratio=options['repeat_buyer_ratio'],
+            sku_count=options['sku_count'])
+        report.seek(0)
+        attachment = self.env['ir.attachment.metadata'].create({
+            'name': 'Amazon benchmark sales',
+            'datas_fname': 'benchmark.csv',
+            'file_type': '_GET_FLAT_FILE_ORDERS_DATA_',
+            'amazon_backend_id': self.backend.id,
+        })
+        with self.measure('sale import', options['orders']):
+            self.env['amazon.sale.importer']._run(report, attachment)
+        reference = 'ir.attachment.metadata,%s' % attachment.id
+        self.assertEqual(
+            self.env['sale.order'].search_count(
+                [('external_origin', '=', reference)]),
+            options['orders'])
+
+    def test_settlement_parser(self):
+        report = StringIO()
+        options = self.options
+        generate_settlement_report(
+            report, orders=options['orders'],
+            lines_per_order=options['lines_per_order'],
+            sku_count=options['sku_count'])
+        journal = self.backend.bank_journal_id or \
+            self.env['account.journal'].search(
+                [('type', '=', 'bank')], limit=1)
+        parser = AmazonFlatV2Parser(journal.with_context(
+            file_name='benchmark', backend=self.backend))
+        parser.filebuffer = report.getvalue()
+        with self.measure('settlement parser', options['orders']):
+            parser._parse()
+        # transfer line, orders and refunds, commissions and fees
+        self.assertGreater(len(parser.result_row_list), options['orders'])
+
+    def tearDown(self):
+        # We leave specific environment
+        self.registry.leave_test_mode()
+        super(AmazonBenchmark, self).tearDown()
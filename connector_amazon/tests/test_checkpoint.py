@@ -0,0 +1,37 @@
+# coding: utf-8
+# © 2017 Akretion
+
+from openerp.tests.common import TransactionCase
+
+
+class AmazonCheckpoint(TransactionCase):
+
+    def setUp(self):
+        super(AmazonCheckpoint, self).setUp()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+
+    def test_processed_ids(self):
+        checkpoint = self.backend._get_checkpoint('fba')
+        self.assertEqual(checkpoint, self.backend._get_checkpoint('fba'))
+        self.assertNotEqual(
+            checkpoint, self.backend._get_checkpoint('report'))
+        checkpoint._mark_processed('402-1', '2017-03-01T08:00:00Z')
+        checkpoint._mark_processed('402-2', '2017-03-02T10:00:00+02:00')
+        self.assertEqual(checkpoint._get_processed_ids(),
+                         set(['402-1', '402-2']))
+        # the next import starts from this date: older orders are
+        # not listed again by Amazon
+        checkpoint._forget_before('2017-03-02 08:00:00')
+        self.assertEqual(checkpoint._get_processed_ids(), set(['402-2']))
+
+    def test_resume_fba_import(self):
+        """ Orders processed by a failed import are skipped """
+        checkpoint = self.backend._get_checkpoint('fba')
+        checkpoint._mark_processed('402-3', '2017-03-01T08:00:00Z')
+        cache = {'orders': set(
+            self.backend._build_sale_order_name(order_id)
+            for order_id in checkpoint._get_processed_ids())}
+        self.assertTrue(self.backend._should_skip_sale_order(
+            '402-3', is_fba=True, cache=cache))
+        self.assertFalse(self.backend._should_skip_sale_order(
+            '402-4', is_fba=True, cache=cache))
@@ -0,0 +1,35 @@
+# coding: utf-8
+# © 2017 Akretion
+
+from openerp.tests.common import TransactionCase
+
+
+class AmazonCountry(TransactionCase):
+
+    def setUp(self):
+        super(AmazonCountry, self).setUp()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+        self.us = self.env.ref('base.us')
+        self.state = self.env['res.country.state'].create({
+            'name': u'Île de Test', 'code': 'IT1',
+            'country_id': self.us.id})
+
+    def test_state_country(self):
+        for name in (u'ile-de-test', u'ÎLE DE TEST', u'I.T.1'):
+            self.assertEqual(
+                self.backend._get_state_country(
+                    {'country': 'US', 'state': name}, 'test'),
+                (self.us.id, self.state.id))
+
+    def test_state_other_country(self):
+        self.assertEqual(
+            self.backend._get_state_country(
+                {'country': 'FR', 'state': u'Île de Test'}, 'test'),
+            (self.env.ref('base.fr').id, False))
+
+    def test_lookup_table_invalidation(self):
+        self.state.name = u'Renamed State'
+        self.assertEqual(
+            self.backend._get_state_country(
+                {'country': 'US', 'state': u'renamed state'}, 'test'),
+            (self.us.id, self.state.id))
@@ -0,0 +1,281 @@
+# coding: utf-8
+# © 2017 Akretion
+
+from openerp.tests.common import TransactionCase
+
+from ..models.amazon_feed import (
+    FULFILLMENT_FEED, INVENTORY_FEED, PRICE_FEED,
+    parse_flat_processing_report, parse_processing_report, xml_feed)
+from .fake_mws import FakeMWS, start_server
+
+PROCESSING_REPORT = """<?xml version="1.0" encoding="UTF-8"?>
+<AmazonEnvelope>
+<Header><DocumentVersion>1.02</DocumentVersion></Header>
+<MessageType>ProcessingReport</MessageType>
+<Message>
+<MessageID>1</MessageID>
+<ProcessingReport>
+<StatusCode>Complete</StatusCode>
+<ProcessingSummary>
+<MessagesProcessed>2</MessagesProcessed>
+<MessagesSuccessful>1</MessagesSuccessful>
+<MessagesWithError>1</MessagesWithError>
+</ProcessingSummary>
+<Result>
+<MessageID>2</MessageID>
+<ResultCode>Error</ResultCode>
+<ResultDescription>SKU not found</ResultDescription>
+<AdditionalInfo><SKU>FEED-B</SKU></AdditionalInfo>
+</Result>
+</ProcessingReport>
+</Message>
+</AmazonEnvelope>
+"""
+
+FLAT_PROCESSING_REPORT = """Feed Processing Summary:
+\tNumber of records processed\t\t2
+\tNumber of records successful\t\t1
+
+original-record-number\torder-id\terror-code\terror-type\terror-message
+2\t402-0000002-0000014\t18028\tError\tThe order id was not found
+"""
+
+
+class AmazonFeedCase(TransactionCase):
+    """ The feeds are submitted to the local stand-in of the api """
+
+    def setUp(self):
+        super(AmazonFeedCase, self).setUp()
+        # without quotas, the tests do not wait
+        self.mws = FakeMWS(quota_scale=0)
+        self.server = start_server(self.mws)
+        self.env.ref('connector_amazon.amazon_main_backend').password = \
+            'secret'
+        self.env = self.env(context=dict(
+            self.env.context, amazon_mws_port=self.server.server_address[1]))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(AmazonFeedCase, self).tearDown()
+
+
+class AmazonStockFeed(AmazonFeedCase):
+
+    def setUp(self):
+        super(AmazonStockFeed, self).setUp()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+        self.exporter = self.env['amazon.stock.exporter']
+        self.product = self.env['product.product'].create({
+            'name': 'Feed A', 'default_code': 'FEED-A', 'type': 'product'})
+        self.binding = self.env['amazon.product'].create({
+            'record_id': self.product.id, 'backend_id': self.backend.id})
+        self.location = self.backend._get_stock_warehouse().lot_stock_id
+
+    def _set_qty(self, qty):
+        self.env['stock.quant'].create({
+            'product_id': self.product.id,
+            'location_id': self.location.id,
+            'qty': qty,
+        })
+
+    def _get_delta(self):
+        for binding_id, sku, qty in self.exporter._get_stock_deltas(
+                self.backend):
+            if binding_id == self.binding.id:
+                return qty
+        return None
+
+    def test_stock_deltas(self):
+        self._set_qty(5)
+        self.assertEqual(self._get_delta(), 5)
+        feed = self.env['amazon.feed']._create_feed(
+            self.backend, '_POST_INVENTORY_AVAILABILITY_DATA_', 'test', 1)
+        self.env['amazon.product']._bulk_write(
+            ['last_qty_sent', 'stock_feed_id'],
+            [(self.binding.id, 5, feed.id)])
+        self.assertEqual(self.binding.last_qty_sent, 5)
+        self.assertIsNone(self._get_delta())
+        self._set_qty(-2)
+        self.assertEqual(self._get_delta(), 3)
+        # a failed feed is sent again
+        self.exporter._reset_feed(feed, ['FEED-A'])
+        self._set_qty(2)
+        self.assertEqual(self._get_delta(), 5)
+
+    def test_feed_content(self):
+        content = self.exporter._build_feed(
+            self.backend, [(self.binding.id, u'FEED-A&B', 3)])
+        self.assertIn('<MessageType>Inventory</MessageType>', content)
+        self.assertIn('<MessageID>1</MessageID>', content)
+        self.assertIn(
+            '<SKU>FEED-A&amp;B</SKU><Quantity>3</Quantity>', content)
+        self.assertEqual(
+            content, xml_feed(self.backend.merchant, 'Inventory', [
+                u'<Inventory><SKU>FEED-A&amp;B</SKU>'
+                u'<Quantity>3</Quantity></Inventory>']))
+
+    def test_export_round_trip(self):
+        self._set_qty(5)
+        self.mws.feed_errors.add('FEED-A')
+        feed = self.exporter._export(self.backend)
+        self.assertEqual(feed.state, 'submitted')
+        feed_type, content = self.mws.feeds[feed.submission_id]
+        self.assertEqual(feed_type, INVENTORY_FEED)
+        self.assertIn('<SKU>FEED-A</SKU><Quantity>5</Quantity>', content)
+        self.assertIsNone(self._get_delta())
+        self.env['amazon.feed']._check_results()
+        self.assertEqual(feed.state, 'done')
+        self.assertEqual(feed.processed_count, feed.record_count)
+        self.assertEqual(feed.error_count, 1)
+        self.assertIn('FEED-A', feed.message)
+        # the rejected SKU is sent again by the next feed
+        self.assertEqual(self._get_delta(), 5)
+        self.mws.feed_errors.clear()
+        feed = self.exporter._export(self.backend)
+        self.assertEqual(feed.record_count, 1)
+        feed.check_result()
+        self.assertEqual(feed.state, 'done')
+        self.assertFalse(feed.error_count)
+        self.assertIsNone(self._get_delta())
+
+    def test_processing_report(self):
+        processed, errors = parse_processing_report(PROCESSING_REPORT)
+        self.assertEqual(processed, 2)
+        self.assertEqual(errors, [('2', 'FEED-B', 'SKU not found')])
+
+
+class AmazonPriceFeed(AmazonFeedCase):
+
+    def setUp(self):
+        super(AmazonPriceFeed, self).setUp()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+        self.exporter = self.env['amazon.price.exporter']
+        self.product = self.env['product.product'].create({
+            'name': 'Price A', 'default_code': 'PRICE-A',
+            'list_price': 20.0})
+        self.binding = self.env['amazon.product'].create({
+            'record_id': self.product.id, 'backend_id': self.backend.id})
+
+    def _get_delta(self):
+        for binding_id, sku, price in self.exporter._get_price_deltas(
+                self.backend):
+            if binding_id == self.binding.id:
+                return price
+        return None
+
+    def test_price_deltas(self):
+        self.assertEqual(self._get_delta(), 20.0)
+        feed = self.env['amazon.feed']._create_feed(
+            self.backend, '_POST_PRODUCT_PRICING_DATA_', 'test', 1)
+        self.env['amazon.product']._bulk_write(
+            ['last_price_sent', 'price_feed_id'],
+            [(self.binding.id, 20.0, feed.id)])
+        self.assertIsNone(self._get_delta())
+        self.product.list_price = 24.5
+        self.assertEqual(self._get_delta(), 24.5)
+        self.exporter._reset_feed(feed)
+        self.product.list_price = 20.0
+        self.assertEqual(self._get_delta(), 20.0)
+
+    def test_export_round_trip(self):
+        self.mws.feed_errors.add('PRICE-A')
+        feed = self.exporter._export(self.backend)
+        feed_type, content = self.mws.feeds[feed.submission_id]
+        self.assertEqual(feed_type, PRICE_FEED)
+        self.assertIn('<SKU>PRICE-A</SKU>', content)
+        self.assertIsNone(self._get_delta())
+        feed.check_result()
+        self.assertEqual(feed.state, 'done')
+        self.assertEqual(feed.error_count, 1)
+        # the rejected price is sent again by the next feed
+        self.assertEqual(self._get_delta(), 20.0)
+
+    def test_feed_content(self):
+        content = self.exporter._build_feed(
+            self.backend, [(self.binding.id, u'PRICE-A', 24.5)])
+        self.assertIn('<MessageType>Price</MessageType>', content)
+        self.assertIn(
+            '<Price><SKU>PRICE-A</SKU><StandardPrice currency="%s">24.50'
+            '</StandardPrice></Price>'
+            % self.backend.pricelist_id.currency_id.name, content)
+
+
+class AmazonShipmentFeed(AmazonFeedCase):
+
+    def setUp(self):
+        super(AmazonShipmentFeed, self).setUp()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+        self.exporter = self.env['amazon.shipment.exporter']
+        product = self.env['product.product'].create({
+            'name': 'Shipped A', 'type': 'product'})
+        self.order = self.env['sale.order'].create({
+            'partner_id': self.env.ref('base.res_partner_2').id,
+            'amazon_backend_id': self.backend.id,
+            'amazon_order_id': '402-0000001-0000007',
+            'order_line': [(0, 0, {
+                'product_id': product.id, 'name': product.name,
+                'product_uom_qty': 1, 'price_unit': 10})],
+        })
+        self.order.signal_workflow('order_confirm')
+        carrier = self.env['delivery.carrier'].create({
+            'name': 'Colissimo Test',
+            'partner_id': self.env.ref('base.res_partner_1').id,
+            'product_id': product.id,
+            'amazon_carrier_code': 'Colissimo',
+        })
+        self.picking = self.order.picking_ids
+        self.picking.write({
+            'carrier_id': carrier.id, 'carrier_tracking_ref': 'TRACK1'})
+
+    def _get_shipment(self):
+        for shipment in self.exporter._get_shipments(self.backend):
+            if shipment['order_id'] == self.order.amazon_order_id:
+                return shipment
+        return None
+
+    def test_shipments(self):
+        self.assertIsNone(self._get_shipment())
+        self.picking.force_assign()
+        self.picking.do_transfer()
+        shipment = self._get_shipment()
+        self.assertEqual(shipment['picking_ids'], self.picking.ids)
+        self.assertEqual(shipment['carrier_code'], 'Colissimo')
+        self.assertEqual(shipment['tracking_ref'], 'TRACK1')
+        content = self.exporter._build_feed(self.backend, [shipment])
+        self.assertIn('402-0000001-0000007\t\t\t', content)
+        self.assertIn('\tColissimo\t\tTRACK1\t', content)
+        # encoded in the charset declared to Amazon
+        content = self.exporter._build_feed(
+            self.backend, [dict(shipment, carrier_name=u'Montr\xe9al')])
+        self.assertIn('\tMontr\xe9al\t', content)
+        # confirmed once, unless the feed fails
+        feed = self.env['amazon.feed']._create_feed(
+            self.backend, '_POST_FLAT_FILE_FULFILLMENT_DATA_', 'test', 1)
+        self.picking.amazon_feed_id = feed
+        self.assertIsNone(self._get_shipment())
+        self.exporter._reset_feed(feed, ['402-0000001-0000007'])
+        self.assertTrue(self._get_shipment())
+
+    def test_export_round_trip(self):
+        self.picking.force_assign()
+        self.picking.do_transfer()
+        self.mws.feed_errors.add('402-0000001-0000007')
+        feed = self.exporter._export(self.backend)
+        feed_type, content = self.mws.feeds[feed.submission_id]
+        self.assertEqual(feed_type, FULFILLMENT_FEED)
+        self.assertIn('402-0000001-0000007\t', content)
+        self.assertEqual(self.picking.amazon_feed_id, feed)
+        feed.check_result()
+        self.assertEqual(feed.state, 'done')
+        self.assertEqual(feed.error_count, 1)
+        # the rejected order is confirmed again by the next feed
+        self.assertFalse(self.picking.amazon_feed_id)
+        self.assertTrue(self._get_shipment())
+
+    def test_processing_report(self):
+        processed, errors = parse_flat_processing_report(
+            FLAT_PROCESSING_REPORT)
+        self.assertEqual(processed, 2)
+        self.assertEqual(errors, [
+            ('2', '402-0000002-0000014', 'The order id was not found')])
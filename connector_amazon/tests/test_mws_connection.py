@@ -0,0 +1,150 @@
+# coding: utf-8
+# © 2017 Akretion
+
+import base64
+import time
+import urllib
+import urllib2
+from datetime import datetime, timedelta
+
+from openerp import api, fields
+from openerp.tests.common import TransactionCase
+
+from ..models.mws_connection import TokenBucket, get_bucket
+from .fake_mws import FakeMWS, start_server
+
+
+class AmazonThrottling(TransactionCase):
+
+    def test_bucket_burst(self):
+        bucket = TokenBucket(2, 0.05)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_bucket_quota_headers(self):
+        bucket = TokenBucket(10, 60)
+        bucket.update(0, time.time() + 0.05)
+        waited = bucket.acquire()
+        self.assertGreater(waited, 0)
+        # the quota is restored when Amazon resets it
+        self.assertLess(waited, 1)
+        self.assertEqual(bucket.acquire(), 0)
+
+    def test_shared_bucket(self):
+        self.assertIs(get_bucket('seller', 'ListOrders'),
+                      get_bucket('seller', 'ListOrdersByNextToken'))
+        self.assertIsNot(get_bucket('seller', 'ListOrders'),
+                         get_bucket('other seller', 'ListOrders'))
+        self.assertIsNone(get_bucket('seller', 'UnknownOperation'))
+
+
+class AmazonFakeMWS(TransactionCase):
+
+    def setUp(self):
+        super(AmazonFakeMWS, self).setUp()
+        self.mws = FakeMWS(reports=3, orders=150)
+        self.server = start_server(self.mws)
+
+    def call(self, path='/', **params):
+        request = urllib2.Request(
+            'http://localhost:%s%s' % (self.server.server_address[1], path),
+            urllib.urlencode(params))
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            response = e
+        return response.getcode(), response.info(), response.read()
+
+    def test_throttling(self):
+        codes = [self.call(Action='GetReportList', Merchant='M')[0]
+                 for index in range(11)]
+        self.assertEqual(codes, [200] * 10 + [503])
+        status, headers, body = self.call(
+            Action='GetReportList', Merchant='M')
+        self.assertIn('<Code>RequestThrottled</Code>', body)
+        self.assertEqual(headers.getheader('x-mws-quota-remaining'), '0')
+
+    def test_orders_next_token(self):
+        path = '/Orders/2013-09-01'
+        status, headers, body = self.call(
+            path, Action='ListOrders', SellerId='M')
+        self.assertEqual(body.count('<Order>'), 100)
+        token = body.split('<NextToken>')[1].split('</NextToken>')[0]
+        status, headers, body = self.call(
+            path, Action='ListOrdersByNextToken', SellerId='M',
+            NextToken=token)
+        self.assertEqual(body.count('<Order>'), 50)
+        self.assertNotIn('<NextToken>', body)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(AmazonFakeMWS, self).tearDown()
+
+
+class AmazonFakeMWSImport(TransactionCase):
+    """ Imports of the backend against the local stand-in """
+
+    def setUp(self):
+        super(AmazonFakeMWSImport, self).setUp()
+        # the imports commit, see test_sale
+        self.registry.enter_test_mode()
+        self.env = api.Environment(
+            self.registry.test_cr, self.env.uid, self.env.context)
+        # without quotas, the tests do not wait
+        self.mws = FakeMWS(reports=2, report_orders=3, orders=3, items=1,
+                           sku_count=5, quota_scale=0)
+        self.server = start_server(self.mws)
+        backend = self.env.ref('connector_amazon.amazon_main_backend')
+        backend.write({
+            'password': 'secret',
+            'sale_import_jobs': False,
+            'import_report_from': fields.Datetime.to_string(
+                datetime.utcnow() - timedelta(days=2)),
+            'import_fba_from': fields.Datetime.to_string(
+                datetime.utcnow() - timedelta(days=2)),
+        })
+        self.backend = backend.with_context(
+            amazon_mws_port=self.server.server_address[1])
+        for sku in self.mws.skus:
+            self.env['amazon.product'].create({
+                'name': sku,
+                'external_id': sku,
+                'backend_id': backend.id,
+            })
+
+    def test_import_report(self):
+        self.backend.import_report()
+        attachments = self.env['ir.attachment.metadata'].search(
+            [('amazon_backend_id', '=', self.backend.id)])
+        report_ids = [self.mws.report_id(index) for index in range(2)]
+        self.assertEqual(
+            sorted(attachments.mapped('amazon_report_id')), report_ids)
+        self.assertEqual(
+            attachments.filtered(
+                lambda a: a.amazon_report_id == report_ids[0]).file_type,
+            '_GET_FLAT_FILE_ORDERS_DATA_')
+        for attachment in attachments:
+            self.assertEqual(
+                base64.b64decode(attachment.datas),
+                self.mws.report_body(attachment.amazon_report_id))
+        # the reports already imported are not downloaded again
+        self.backend.import_report()
+        self.assertEqual(self.mws.stats.get('GetReport 200'), 2)
+
+    def test_import_fba_delivered_sales(self):
+        self.backend.import_fba_delivered_sales()
+        order_ids = [self.mws.order_id(index) for index in range(3)]
+        sales = self.env['sale.order'].search(
+            [('amazon_order_id', 'in', order_ids)])
+        self.assertEqual(len(sales), 3)
+        self.assertEqual(self.mws.stats.get('ListOrderItems 200'), 3)
+        self.assertGreater(self.backend.import_fba_from,
+                           fields.Datetime.to_string(self.mws.start))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.registry.leave_test_mode()
+        super(AmazonFakeMWSImport, self).tearDown()
@@ -0,0 +1,142 @@
+# coding: utf-8
+# © 2017 Akretion
+
+import base64
+from datetime import datetime
+from StringIO import StringIO
+
+from openerp.tests.common import TransactionCase
+
+from ..models.amazon_payment_importer import (
+    AmazonFlatV2Parser, AmountParser, format_date)
+from .report_generator import SETTLEMENT_HEADER
+
+HEADER = ['settlement-id', 'transaction-type', 'order-id', 'amount-type',
+          'amount-description', 'amount']
+ROWS = [
+    ['1', 'Order', '404-1', 'ItemPrice', 'Principal', '10,50'],
+    ['1', 'Order', '404-1', 'ItemFees', 'Commission', '-1,57'],
+    ['1', 'Order', '404-2', 'Promotion', 'Shipping', '-2.00'],
+    [],
+    ['1', 'Refund', '404-1', 'ItemPrice', 'Principal', '-10,50'],
+    ['1', 'Order', '404-1', 'ItemPrice', 'Shipping', '4.90'],
+    ['1', 'other-transaction', '', 'Other', 'Storage Fee', '-3.20'],
+    ['1', 'Order', '404-2', 'ItemFees', 'Commission', '-0.30'],
+]
+
+
+class AmazonPayment(TransactionCase):
+
+    def test_aggregate_rows(self):
+        parser = AmazonFlatV2Parser.__new__(AmazonFlatV2Parser)
+        expected = parser._merge_line(
+            [dict(zip(HEADER, row)) for row in ROWS if row])
+        result = parser._aggregate_rows(iter(ROWS), HEADER)
+        self.assertEqual(result.items(), expected.items())
+        self.assertEqual(result['Order']['404-1']['amount'], 15.4)
+        self.assertEqual(result['Commission'], -1.87)
+
+    def test_format_date(self):
+        for date_str in ('2017-03-01 08:00:00 UTC',
+                         '01.03.2017 08:00:00 UTC',
+                         '2017/03/01 17:00:00 JST',
+                         '01-03-2017 13:30:00 IST',
+                         '2017-03-01T00:00:00-08:00',
+                         '2017-03-01 00:00:00 PST'):
+            self.assertEqual(format_date(date_str), '2017-03-01 08:00:00')
+
+    def test_amount_parser(self):
+        for values, expected in (
+                (['', '10,50', '-4,9'], [0.0, 10.5, -4.9]),
+                (['12', '1,234.50'], [12.0, 1234.5]),
+                (['1.234,50', '-3,20'], [1234.5, -3.2]),
+                (['1,23,456.78'], [123456.78])):
+            amounts = AmountParser()
+            self.assertEqual([amounts.convert(val) for val in values],
+                             expected)
+        self.assertEqual(AmountParser('JPY').convert('1,234'), 1234.0)
+
+
+class AmazonSettlement(TransactionCase):
+
+    def setUp(self):
+        super(AmazonSettlement, self).setUp()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+        self.receivable = self.env.ref('account.a_recv')
+        self.journal = self.env.ref('account.bank_journal')
+        self.journal.write({
+            'import_type': 'amazon_flat_v2',
+            'receivable_account_id': self.receivable.id,
+            'commission_account_id': self.env.ref('account.a_expense').id,
+            'partner_id': self.env.ref('base.res_partner_1').id,
+        })
+        self.backend.bank_journal_id = self.journal
+
+    def _create_invoice(self, partner, order_id):
+        invoice = self.env['account.invoice'].create({
+            'partner_id': partner.id,
+            'account_id': self.receivable.id,
+            'amazon_order_id': order_id,
+            'invoice_line': [(0, 0, {
+                'name': 'Amazon product',
+                'account_id': self.env.ref('account.a_sale').id,
+                'quantity': 1,
+                'price_unit': 10.5,
+            })],
+        })
+        invoice.signal_workflow('invoice_open')
+        return invoice
+
+    def _import_settlement(self, order_ids):
+        rows = [dict.fromkeys(SETTLEMENT_HEADER, '')]
+        rows[0].update({
+            'settlement-id': '1',
+            'settlement-end-date': datetime.utcnow().strftime(
+                '%d.%m.%Y %H:%M:%S UTC'),
+            'total-amount': '%.2f' % (10.5 * len(order_ids)),
+            'currency': 'EUR',
+        })
+        for order_id in order_ids:
+            row = dict.fromkeys(SETTLEMENT_HEADER, '')
+            row.update({
+                'settlement-id': '1',
+                'transaction-type': 'Order',
+                'order-id': order_id,
+                'amount-type': 'ItemPrice',
+                'amount-description': 'Principal',
+                'amount': '10.50',
+            })
+            rows.append(row)
+        data = ''.join(
+            '\t'.join(values) + '\n' for values in [SETTLEMENT_HEADER] +
+            [[row[name] for name in SETTLEMENT_HEADER] for row in rows])
+        attachment = self.env['ir.attachment.metadata'].create({
+            'name': 'settlement-1',
+            'datas': base64.b64encode(data),
+            'datas_fname': 'settlement-1.csv',
+            'file_type': '_GET_V2_SETTLEMENT_REPORT_DATA_FLAT_FILE_V2_',
+            'amazon_backend_id': self.backend.id,
+        })
+        return self.env['amazon.payment.importer']._run(
+            StringIO(data), attachment)
+
+    def _get_line(self, move, order_id):
+        return move.line_id.filtered(
+            lambda line: line.amazon_order_id == order_id)
+
+    def test_settle_invoice(self):
+        partner = self.env.ref('base.res_partner_2')
+        invoice = self._create_invoice(partner, '404-1')
+        move = self._import_settlement(['404-1'])
+        line = self._get_line(move, '404-1')
+        self.assertEqual(line.partner_id, partner)
+        self.assertTrue(line.reconcile_id)
+        self.assertEqual(invoice.state, 'paid')
+
+    def test_order_invoiced_to_several_partners(self):
+        self._create_invoice(self.env.ref('base.res_partner_2'), '404-2')
+        self._create_invoice(self.env.ref('base.res_partner_3'), '404-2')
+        move = self._import_settlement(['404-2'])
+        line = self._get_line(move, '404-2')
+        self.assertFalse(line.partner_id)
+        self.assertFalse(line.reconcile_id or line.reconcile_partial_id)
@@ -0,0 +1,72 @@
+# coding: utf-8
+# © 2017 Akretion
+
+from StringIO import StringIO
+
+from openerp.tests.common import TransactionCase
+
+LISTINGS = u"""item-name\tseller-sku\tasin1\tproduct-id\tproduct-id-type
+Populate A\tPOPULATE-A\tB000000001\tB000000001\t1
+By EAN\tEAN-SKU\tB000000002\t4006381333931\t4
+Unknown\tUNKNOWN-SKU\tB000000003\tB000000003\t1
+By UPC\tUPC-SKU\t\t036000291452\t3
+"""
+
+
+class AmazonProductBinding(TransactionCase):
+
+    def setUp(self):
+        super(AmazonProductBinding, self).setUp()
+        self.backend = self.env.ref('connector_amazon.amazon_main_backend')
+        product_m = self.env['product.product']
+        self.products = product_m.browse([
+            product_m.create({'name': name, 'default_code': code}).id
+            for name, code in (('Populate A', 'POPULATE-A'),
+                               ('Populate B', 'POPULATE-B'),
+                               ('Same SKU as A', 'POPULATE-A'),
+                               ('No reference', False))])
+
+    def test_populate(self):
+        binding_m = self.env['amazon.product']
+        domain = [('id', 'in', self.products.ids)]
+        self.assertEqual(binding_m._populate(self.backend, domain), 2)
+        bindings = binding_m.search([('record_id', 'in', self.products.ids)])
+        self.assertEqual(sorted(bindings.mapped('external_id')),
+                         ['POPULATE-A', 'POPULATE-B'])
+        # only the missing bindings are created
+        bindings.filtered(lambda b: b.external_id == 'POPULATE-B').unlink()
+        self.assertEqual(binding_m._populate(self.backend, domain), 1)
+        self.assertEqual(binding_m._populate(self.backend, domain), 0)
+
+    def test_populate_button(self):
+        self.backend.populate_amazon_binding()
+        self.assertIn('products bound',
+                      self.backend.message_ids[0].body)
+
+    def test_listing_bindings(self):
+        binding_m = self.env['amazon.product']
+        importer = self.env['amazon.listing.importer']
+        by_ean = self.env['product.product'].create({
+            'name': 'By EAN', 'ean13': '4006381333931'})
+        by_upc = self.env['product.product'].create({
+            'name': 'By UPC', 'ean13': '0036000291452'})
+        listings = importer._read_listings(
+            StringIO(LISTINGS.encode('utf-8')), self.backend)
+        to_create, to_update, errors = importer._diff_bindings(
+            self.backend, listings)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('UNKNOWN-SKU', errors[0])
+        binding_m._insert_bindings(to_create)
+        binding_m._update_asins(to_update)
+        binding = binding_m.search([('record_id', '=', by_ean.id)])
+        self.assertEqual(binding.external_id, 'EAN-SKU')
+        self.assertEqual(binding.asin, 'B000000002')
+        upc_binding = binding_m.search([('record_id', '=', by_upc.id)])
+        self.assertEqual(upc_binding.external_id, 'UPC-SKU')
+        self.assertFalse(upc_binding.asin)
+        # the ASIN of the existing bindings is synchronized
+        binding.asin = 'B000000009'
+        to_create, to_update, errors = importer._diff_bindings(
+            self.backend, listings)
+        self.assertFalse(to_create)
+        self.assertEqual(to_update, [(binding.id, 'B000000002')])
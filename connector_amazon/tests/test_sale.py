@@ -34,6 +34,116 @@ class AmazonSale(TransactionCase):
         sales = self.env['sale.order'].search(
             [('external_origin', '=', reference)])
         self.assertEqual(len(sales), 10)
+        for sale in sales:
+            self.assertEqual(
+                sale.name,
+                sale.amazon_backend_id._build_sale_order_name(
+                    sale.amazon_order_id))
+        run = self.env['amazon.import.run'].search(
+            [('attachment_id', '=', attachm.id)])
+        self.assertEqual(run.run_type, 'sale')
+        self.assertEqual(run.record_count, 10)
+        self.assertIn('order creation', run.phase_ids.mapped('name'))
+
+    def test_products_from_sku(self):
+        backend = self.env.ref('connector_amazon.amazon_main_backend')
+        products = backend._get_products_from_sku(['B3423', 'UNKNOWN'])
+        self.assertEqual(
+            products,
+            {'B3423': self.env.ref('product.product_product_5b').id})
+
+    def test_address_hash(self):
+        backend = self.env.ref('connector_amazon.amazon_main_backend')
+        address = {'name': u'Lara CLEYTE', 'street': u'41 rue du disque',
+                   'city': u'Marseille', 'zip': u'13007', 'country': u'FR'}
+        same = dict(address, name=u' lara  Cleyte ', street2=False)
+        self.assertEqual(backend._get_address_hash(address),
+                         backend._get_address_hash(same))
+        other = dict(address, zip=u'13008')
+        self.assertNotEqual(backend._get_address_hash(address),
+                            backend._get_address_hash(other))
+
+    def _get_sale_data(self, origin, sku):
+        return {
+            'auto_insert': {'origin': origin},
+            'partner': {'email': '%s@marketplace.amazon.fr' % origin,
+                        'name': 'Buyer %s' % origin, 'phone': False},
+            'part_ship': {'name': 'Buyer %s' % origin, 'type': 'delivery',
+                          'street': '1 rue du test', 'city': 'Lyon',
+                          'zip': '69001', 'country': 'FR'},
+            'lines': [{'sku': sku, 'name': sku, 'product_uom_qty': 1,
+                       'price_unit': 10., 'shipping': 0., 'discount': 0}],
+        }
+
+    def test_create_sales_isolate_error(self):
+        backend = self.env.ref('connector_amazon.amazon_main_backend')
+        errors = backend._create_sales([
+            self._get_sale_data('TEST-OK', 'B3423'),
+            self._get_sale_data('TEST-KO', 'UNKNOWN'),
+        ])
+        self.assertEqual(len(errors), 1)
+        self.assertIn('TEST-KO', errors[0])
+        names = backend._get_existing_sale_names(['TEST-OK', 'TEST-KO'])
+        self.assertEqual(names, {backend._build_sale_order_name('TEST-OK')})
+
+    def test_iter_sales_not_consecutive(self):
+        importer = self.env['amazon.sale.importer']
+        fieldnames = importer._get_header_fieldnames()
+
+        def line(order_id, item_id):
+            values = dict.fromkeys(fieldnames, u'')
+            values.update({
+                'order-id': order_id, 'order-item-id': item_id,
+                'sku': u'B3423', 'quantity-purchased': u'1',
+                'item-price': u'10.00', 'shipping-price': u'0.00'})
+            return values
+
+        errors = []
+        sales = list(importer._iter_sales([
+            line('ORDER-1', '1'), line('ORDER-2', '2'),
+            line('ORDER-1', '3'), line('ORDER-2', '4')], errors=errors))
+        self.assertEqual([(sale['auto_insert']['origin'], len(sale['lines']))
+                          for sale in sales],
+                         [('ORDER-1', 1), ('ORDER-2', 2)])
+        self.assertEqual(len(errors), 1)
+        self.assertIn('ORDER-1', errors[0])
+
+    def test_report_state_from_chunks(self):
+        attachm = self.env.ref('connector_amazon.amazon_sale_demo2')
+        chunk_m = self.env['amazon.report.chunk']
+        chunks = chunk_m.browse([
+            chunk_m.create({'attachment_id': attachm.id,
+                            'sequence': sequence}).id
+            for sequence in (1, 2)])
+        # done when the jobs are enqueued by the attachment run
+        attachm.write({'state': 'done'})
+        self.assertEqual(attachm.state, 'pending')
+        chunks[0].write({'state': 'done'})
+        attachm._update_chunk_state()
+        self.assertEqual(attachm.state, 'pending')
+        chunks[1].write({'state': 'failed', 'message': 'Order 404-1 failed'})
+        attachm._update_chunk_state()
+        self.assertEqual(attachm.state, 'failed')
+        self.assertEqual(attachm.state_message, 'Order 404-1 failed')
+        chunks[1].write({'state': 'done'})
+        attachm._update_chunk_state()
+        self.assertEqual(attachm.state, 'done')
+
+    def test_split_in_jobs_once(self):
+        attachm = self.env.ref('connector_amazon.amazon_sale_demo2')
+        attachm.amazon_backend_id.sale_import_chunk_size = 4
+        importer = self.env['amazon.sale.importer']
+        importer._split_in_jobs(attachm._open_report(), attachm)
+        chunks = attachm.amazon_chunk_ids
+        self.assertEqual(sum(chunks.mapped('order_count')), 10)
+        chunks[0].write({'state': 'done'})
+        chunks[1].write({'state': 'failed', 'message': 'Order failed'})
+        # run again by the scheduler while the chunks run
+        importer._split_in_jobs(attachm._open_report(), attachm)
+        self.assertEqual(attachm.amazon_chunk_ids, chunks)
+        self.assertEqual(chunks.mapped('state'),
+                         ['done'] + ['pending'] * (len(chunks) - 1))
+        self.assertFalse(chunks[1].message)
 
     def tearDown(self):
         # We leave specific environment